@@ -0,0 +1,271 @@
+"""Core affinity and thread counts for CPU-only generation workers.
+
+Several run_pplm_example processes on one host each start torch's default
+intra-op pool over every core and oversubscribe the machine. This module
+reads the physical core / NUMA layout, gives every worker a disjoint set of
+physical cores (one logical cpu per core, so SMT siblings are not shared),
+sets its intra-/inter-op thread counts to match and asks libnuma, when
+present, to allocate memory on the local node. Without libnuma pinning
+still makes first-touch allocations land on the worker's node.
+
+    python cpu_affinity.py topology
+    python cpu_affinity.py calibrate sweep.json
+    python cpu_affinity.py worker queue.db --workers 4 --threads 2
+"""
+import argparse
+import ctypes
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import time
+
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+def parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def usable_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_topology():
+    """
+    Returns {numa node: [[logical cpus of one physical core], ...]} for the
+    cpus this process may run on.
+    """
+    node_of = {}
+    for node_dir in glob.glob("/sys/devices/system/node/node[0-9]*"):
+        node = int(os.path.basename(node_dir)[len("node"):])
+        for cpu in parse_cpulist(_read(os.path.join(node_dir, "cpulist"), "")):
+            node_of[cpu] = node
+
+    cores = {}
+    for cpu in usable_cpus():
+        topology = "/sys/devices/system/cpu/cpu{}/topology/".format(cpu)
+        package = int(_read(topology + "physical_package_id", 0))
+        core = int(_read(topology + "core_id", cpu))
+        cores.setdefault((node_of.get(cpu, 0), package, core), []).append(cpu)
+
+    layout = {}
+    for (node, _, _), cpus in sorted(cores.items()):
+        layout.setdefault(node, []).append(sorted(cpus))
+    return layout
+
+
+def plan_workers(workers, threads=None, topology=None):
+    """
+    Splits the physical cores into one disjoint set per worker. Cores are
+    handed out node by node, so a worker only spans two NUMA nodes when the
+    node sizes are not a multiple of threads.
+    """
+    topology = topology or cpu_topology()
+    cores = [(node, core) for node in sorted(topology)
+             for core in topology[node]]
+    threads = threads or max(len(cores) // workers, 1)
+    if workers * threads > len(cores):
+        raise ValueError("{} workers x {} threads needs {} physical cores, "
+                         "only {} available".format(
+                             workers, threads, workers * threads, len(cores)))
+
+    assignments = []
+    for index in range(workers):
+        chunk = cores[index * threads:(index + 1) * threads]
+        nodes = [node for node, _ in chunk]
+        assignments.append({
+            "cpus": [core[0] for _, core in chunk],
+            "node": max(set(nodes), key=nodes.count),
+            "intra_op_threads": threads,
+            "inter_op_threads": 1,
+        })
+    return assignments
+
+
+def _bind_memory_to_local_node():
+    try:
+        numa = ctypes.CDLL("libnuma.so.1")
+    except OSError:
+        return False
+    if numa.numa_available() < 0:
+        return False
+    numa.numa_set_localalloc()
+    return True
+
+
+def apply_assignment(assignment):
+    """Pins the calling process; call it before the model is loaded."""
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(assignment["intra_op_threads"])
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, assignment["cpus"])
+    _bind_memory_to_local_node()
+
+    import torch
+    torch.set_num_threads(assignment["intra_op_threads"])
+    try:
+        torch.set_num_interop_threads(assignment["inter_op_threads"])
+    except RuntimeError:
+        # only settable before the first inter-op parallel work
+        pass
+
+
+def _pinned_queue_worker(db_path, assignment):
+    apply_assignment(assignment)
+    from sweep_queue import run_worker
+    run_worker(db_path)
+
+
+def run_pinned_workers(db_path, workers, threads=None):
+    """Runs sweep_queue workers on this host, each on its own cores."""
+    context = multiprocessing.get_context("spawn")
+    procs = [context.Process(target=_pinned_queue_worker,
+                             args=(db_path, assignment))
+             for assignment in plan_workers(workers, threads)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+
+def _calibration_worker(assignment, jobs, results):
+    try:
+        apply_assignment(assignment)
+        from sweep_queue import run_job
+        # a one token run loads the model and tokenizer (kept by score_model
+        # for the process), so only generation is timed
+        run_job(dict(jobs[0], length=1))
+        start = time.time()
+        for params in jobs:
+            run_job(params)
+    except Exception:
+        # a failed split counts as zero throughput instead of hanging
+        results.put(float("inf"))
+        raise
+    results.put(time.time() - start)
+
+
+def _collect(procs, results, poll_seconds=1.0):
+    """One elapsed time per worker; workers that died without one get inf."""
+    elapsed = []
+    while len(elapsed) < len(procs):
+        try:
+            elapsed.append(results.get(timeout=poll_seconds))
+        except queue.Empty:
+            if all(proc.exitcode is not None for proc in procs):
+                elapsed.extend([float("inf")] * (len(procs) - len(elapsed)))
+    return elapsed
+
+
+def candidate_splits(cores):
+    """workers x threads splits using powers of two workers plus one per core."""
+    workers = set([cores])
+    count = 1
+    while count < cores:
+        workers.add(count)
+        count *= 2
+    return sorted((count, cores // count) for count in workers)
+
+
+def calibrate(spec, length=10, jobs_per_worker=1, splits=None, topology=None,
+              verbosity_level=1):
+    """
+    Runs a few shortened jobs of a sweep under each workers x threads split
+    and returns (best split, [{workers, threads, jobs_per_second}, ...]).
+    Every worker loads the model in an untimed warm-up run first, so the
+    ranking reflects generation throughput rather than loading.
+    """
+    from sweep_queue import expand_sweep
+
+    topology = topology or cpu_topology()
+    cores = sum(len(node_cores) for node_cores in topology.values())
+    splits = splits or candidate_splits(cores)
+    sweep_jobs = list(expand_sweep(spec))
+    if not sweep_jobs:
+        raise ValueError("the sweep spec has no jobs")
+
+    context = multiprocessing.get_context("spawn")
+    table = []
+    for workers, threads in splits:
+        jobs = []
+        for index in range(workers * jobs_per_worker):
+            params = dict(sweep_jobs[index % len(sweep_jobs)])
+            params.update(length=length, verbosity="quiet", no_cuda=True)
+            jobs.append(params)
+
+        results = context.Queue()
+        procs = [context.Process(
+                    target=_calibration_worker,
+                    args=(assignment,
+                          jobs[index::workers],
+                          results))
+                 for index, assignment in enumerate(
+                     plan_workers(workers, threads, topology))]
+        for proc in procs:
+            proc.start()
+        elapsed = max(_collect(procs, results))
+        for proc in procs:
+            proc.join()
+
+        row = {"workers": workers, "threads": threads,
+               "jobs_per_second": len(jobs) / elapsed}
+        if verbosity_level >= 1:
+            print(json.dumps(row))
+        table.append(row)
+
+    best = max(table, key=lambda row: row["jobs_per_second"])
+    return (best["workers"], best["threads"]), table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    sub = parser.add_subparsers(dest="command")
+
+    sub.add_parser("topology", help="show numa nodes and physical cores")
+
+    calibrate_parser = sub.add_parser(
+        "calibrate", help="pick the fastest workers x threads split")
+    calibrate_parser.add_argument("spec")
+    calibrate_parser.add_argument("--length", type=int, default=10)
+    calibrate_parser.add_argument("--jobs_per_worker", type=int, default=1)
+
+    worker_parser = sub.add_parser(
+        "worker", help="run pinned sweep_queue workers")
+    worker_parser.add_argument("db")
+    worker_parser.add_argument("--workers", type=int, default=1)
+    worker_parser.add_argument("--threads", type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == "topology":
+        print(json.dumps(cpu_topology(), indent=2))
+    elif args.command == "calibrate":
+        with open(args.spec) as f:
+            spec = json.load(f)
+        (workers, threads), _ = calibrate(spec, args.length,
+                                          args.jobs_per_worker)
+        print("best: --workers {} --threads {}".format(workers, threads))
+    elif args.command == "worker":
+        run_pinned_workers(args.db, args.workers, args.threads)
+    else:
+        parser.print_help()
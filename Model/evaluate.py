@@ -0,0 +1,301 @@
+"""Batch evaluation of sweep results.
+
+Reads the JSON lines written by `run.py --out` or `sweep_queue.py results`
+and scores every generated text on
+
+* perplexity under the base LM, in padded batches sorted by length,
+* topic hit rate: share of words that are in the requested bags of words,
+* affect intensity: mean lexicon intensity of the requested affect's words
+  and its alignment with the requested knob (1 - |intensity - knob|),
+* distinct-1/2/3 diversity.
+
+The text metrics run over chunks of rows in a process pool; inside a chunk
+they are computed on one flat array of word ids with per-row segment sums.
+
+    python evaluate.py results.jsonl --out scored.jsonl
+    python evaluate.py gate_results.jsonl --group_by gate_threshold
+"""
+import argparse
+import json
+import multiprocessing
+import re
+
+import numpy as np
+
+WORD_RE = re.compile(r"[a-z]+(?:'[a-z]+)?")
+EOS_TEXT = "<|endoftext|>"
+DISTINCT_N = (1, 2, 3)
+
+# lexicons shared with the pool workers
+_BAGS = {}
+_AFFECTS = {}
+
+
+def load_results(path):
+    rows = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            result = row.get("result")
+            if isinstance(result, dict):
+                texts = result.get("texts", [result.get("text")])
+            else:
+                texts = [result]
+            # one row per perturbed sample
+            for index, text in enumerate(texts):
+                sample = dict(row, sample=index)
+                sample["text"] = (text or "").replace(EOS_TEXT, " ").strip()
+                if isinstance(result, dict):
+                    if index < len(result.get("int_scores", [])):
+                        sample["int_score"] = result["int_scores"][index]
+                    # perturbation iterations actually run, see gating
+                    if index < len(result.get("gate_iterations") or []):
+                        sample["iterations"] = sum(
+                            result["gate_iterations"][index])
+                rows.append(sample)
+    return rows
+
+
+def load_lexicons(rows):
+    """Topic bags (word sets) and affect lexicons (word -> intensity)."""
+    from score_model import (BAG_OF_WORDS_ARCHIVE_MAP, cached_path,
+                             get_affect_words_and_int)
+
+    bags, affects = {}, {}
+    for row in rows:
+        params = row.get("params", {})
+        for name in (params.get("bag_of_words") or "").split(";"):
+            if name and name not in bags:
+                path = (cached_path(BAG_OF_WORDS_ARCHIVE_MAP[name])
+                        if name in BAG_OF_WORDS_ARCHIVE_MAP else name)
+                with open(path) as f:
+                    bags[name] = set(w.strip().lower()
+                                     for w in f.read().strip().split("\n"))
+        for affect in (params.get("bag_of_words_affect") or "").split(";"):
+            if affect and affect not in affects:
+                words, intensities = get_affect_words_and_int(affect)
+                affects[affect] = dict(zip(words, intensities))
+    return bags, affects
+
+
+def _init_worker(bags, affects):
+    _BAGS.update(bags)
+    _AFFECTS.update(affects)
+
+
+def _segment_sum(values, segments, count):
+    return np.bincount(segments, weights=values, minlength=count)
+
+
+def score_texts(chunk):
+    """Text metrics for a list of (text, bag_of_words, affect, knob) rows."""
+    count = len(chunk)
+    vocab = {}
+    ids, lengths = [], []
+    for text, _, _, _ in chunk:
+        words = WORD_RE.findall(text.lower())
+        ids.extend(vocab.setdefault(word, len(vocab)) for word in words)
+        lengths.append(len(words))
+    ids = np.asarray(ids, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    segments = np.repeat(np.arange(count), lengths)
+    words = list(vocab)
+    safe_lengths = np.maximum(lengths, 1)
+
+    metrics = {}
+
+    # topic hit rate, one vectorised pass per distinct bag spec
+    hits = np.zeros(count)
+    topics = np.array([row[1] or "" for row in chunk], dtype=object)
+    for spec in set(topics):
+        bag = set().union(*(_BAGS.get(name, ()) for name in spec.split(";")))
+        if not bag:
+            continue
+        in_bag = np.fromiter((word in bag for word in words), bool, len(words))
+        rows = topics == spec
+        hits += _segment_sum(in_bag[ids] & rows[segments], segments, count)
+    metrics["topic_hit_rate"] = hits / safe_lengths
+    metrics["topic_hit"] = (hits > 0).astype(float)
+
+    # affect intensity of the matched lexicon words
+    total = np.zeros(count)
+    matched = np.zeros(count)
+    affects = np.array([row[2] or "" for row in chunk], dtype=object)
+    for affect in set(affects):
+        lexicon = {}
+        for name in affect.split(";"):
+            for word, value in _AFFECTS.get(name, {}).items():
+                lexicon.setdefault(word, value)
+        if not lexicon:
+            continue
+        intensity = np.fromiter((lexicon.get(word, np.nan) for word in words),
+                                float, len(words))
+        values = intensity[ids]
+        valid = ~np.isnan(values) & (affects == affect)[segments]
+        total += _segment_sum(np.where(valid, values, 0.0), segments, count)
+        matched += _segment_sum(valid, segments, count)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_intensity = total / matched
+    knobs = np.array([np.nan if row[3] is None else row[3] for row in chunk],
+                     dtype=float)
+    metrics["affect_words"] = matched
+    metrics["affect_intensity"] = mean_intensity
+    metrics["affect_alignment"] = 1 - np.abs(mean_intensity - knobs)
+
+    # distinct-n: unique (row, n-gram) pairs over n-grams per row
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    positions = np.arange(len(ids)) - starts[segments]
+    base = max(len(words), 1)
+    for n in DISTINCT_N:
+        valid = positions + n <= lengths[segments]
+        keys = np.zeros(len(ids), dtype=np.int64)
+        for offset in range(n):
+            shifted = np.zeros(len(ids), dtype=np.int64)
+            shifted[:len(ids) - offset] = ids[offset:]
+            keys = keys * base + shifted
+        pairs = np.stack((segments[valid], keys[valid]), axis=1)
+        unique = np.unique(pairs, axis=0) if len(pairs) else pairs
+        distinct = np.bincount(unique[:, 0], minlength=count) if len(unique) \
+            else np.zeros(count)
+        ngrams = np.maximum(lengths - n + 1, 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            metrics["distinct_{}".format(n)] = distinct / ngrams
+    return metrics
+
+
+def text_metrics(rows, bags, affects, workers=None, chunk_size=256):
+    items = [(row["text"],
+              row.get("params", {}).get("bag_of_words"),
+              row.get("params", {}).get("bag_of_words_affect"),
+              row.get("params", {}).get("knob"))
+             for row in rows]
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    if workers == 1 or len(chunks) <= 1:
+        _init_worker(bags, affects)
+        scored = [score_texts(chunk) for chunk in chunks]
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_worker,
+                                  initargs=(bags, affects)) as pool:
+            scored = pool.map(score_texts, chunks)
+    if not scored:
+        return {}
+    return {key: np.concatenate([chunk[key] for chunk in scored])
+            for key in scored[0]}
+
+
+def perplexity(texts, pretrained_model="gpt2-medium", batch_size=16,
+               device=None):
+    """Per-text perplexity under the base LM, in padded length-sorted batches."""
+    import torch
+    import torch.nn.functional as F
+    from transformers import GPT2Tokenizer
+    from transformers.modeling_gpt2 import GPT2LMHeadModel
+
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = GPT2Tokenizer.from_pretrained(pretrained_model)
+    model = GPT2LMHeadModel.from_pretrained(pretrained_model).to(device).eval()
+
+    encoded = [tokenizer.encode(tokenizer.bos_token + text)[:model.config.n_ctx]
+               for text in texts]
+    order = np.argsort([len(tokens) for tokens in encoded])
+    result = np.full(len(texts), np.nan)
+    with torch.no_grad():
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            width = max(len(encoded[i]) for i in batch)
+            input_ids = torch.full((len(batch), width),
+                                   tokenizer.eos_token_id, dtype=torch.long)
+            mask = torch.zeros((len(batch), width), dtype=torch.long)
+            for row, i in enumerate(batch):
+                input_ids[row, :len(encoded[i])] = torch.tensor(encoded[i])
+                mask[row, :len(encoded[i])] = 1
+            input_ids, mask = input_ids.to(device), mask.to(device)
+
+            logits = model(input_ids, attention_mask=mask)[0]
+            nll = F.cross_entropy(
+                logits[:, :-1].reshape(-1, logits.shape[-1]),
+                input_ids[:, 1:].reshape(-1),
+                reduction="none"
+            ).view(len(batch), -1)
+            target_mask = mask[:, 1:].float()
+            tokens = target_mask.sum(dim=1).clamp(min=1)
+            mean_nll = (nll * target_mask).sum(dim=1) / tokens
+            result[batch] = torch.exp(mean_nll).cpu().numpy()
+    return result
+
+
+def summarize(rows, metrics):
+    summary = {key: float(np.nanmean(values)) if np.any(~np.isnan(values))
+               else None
+               for key, values in metrics.items()}
+    knobs = np.array([row.get("params", {}).get("knob") for row in rows],
+                     dtype=float)
+    intensity = metrics.get("affect_intensity")
+    if intensity is not None:
+        valid = ~np.isnan(knobs) & ~np.isnan(intensity)
+        if valid.sum() > 1 and np.std(knobs[valid]) > 0 \
+                and np.std(intensity[valid]) > 0:
+            summary["knob_intensity_corr"] = float(
+                np.corrcoef(knobs[valid], intensity[valid])[0, 1])
+    for key in ("int_score", "iterations"):
+        values = [row[key] for row in rows if key in row]
+        if values:
+            summary[key] = float(np.mean(values))
+    summary["rows"] = len(rows)
+    return summary
+
+
+def group_summaries(rows, metrics, key):
+    """Summaries per value of the sweep parameter `key`, e.g. gate on/off."""
+    groups = {}
+    for index, row in enumerate(rows):
+        value = row.get("params", {}).get(key)
+        groups.setdefault(json.dumps(value), []).append(index)
+    return {
+        "{}={}".format(key, value): summarize(
+            [rows[i] for i in indices],
+            {name: values[indices] for name, values in metrics.items()})
+        for value, indices in sorted(groups.items())
+    }
+
+
+def evaluate(path, out=None, pretrained_model="gpt2-medium", batch_size=16,
+             workers=None, ppl=True, group_by=None):
+    rows = load_results(path)
+    bags, affects = load_lexicons(rows)
+    metrics = text_metrics(rows, bags, affects, workers=workers)
+    if ppl and rows:
+        metrics["perplexity"] = perplexity([row["text"] for row in rows],
+                                           pretrained_model, batch_size)
+    if out:
+        with open(out, "w") as f:
+            for index, row in enumerate(rows):
+                row["metrics"] = {
+                    key: None if np.isnan(values[index]) else float(values[index])
+                    for key, values in metrics.items()
+                }
+                f.write(json.dumps(row) + "\n")
+    if group_by:
+        return group_summaries(rows, metrics, group_by)
+    return summarize(rows, metrics)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score sweep results")
+    parser.add_argument("results", help="JSON lines results file")
+    parser.add_argument("--out", help="write per-row metrics as JSON lines")
+    parser.add_argument("--pretrained_model", default="gpt2-medium")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no_ppl", action="store_true",
+                        help="skip the perplexity pass")
+    parser.add_argument("--group_by",
+                        help="summarise per value of this sweep parameter")
+    args = parser.parse_args()
+    print(json.dumps(evaluate(args.results, args.out, args.pretrained_model,
+                              args.batch_size, args.workers,
+                              ppl=not args.no_ppl,
+                              group_by=args.group_by),
+                     indent=2, sort_keys=True))
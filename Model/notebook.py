@@ -0,0 +1,32 @@
+"""Notebook-only widgets for run_pplm_example (requires ipywidgets)."""
+import ipywidgets as widgets
+from ipywidgets import interact_manual
+
+from lexicons import AFFECT_CLASSES, BAG_OF_WORDS_ARCHIVE_MAP
+from score_model import run_pplm_example
+
+
+def pplm_widget(**kwargs):
+    """
+    Shows prompt, topic, affect and knob controls and runs
+    run_pplm_example with them; kwargs are passed through unchanged.
+    """
+    def generate(cond_text, bag_of_words, bag_of_words_affect, knob):
+        return run_pplm_example(
+            cond_text=cond_text,
+            bag_of_words=bag_of_words,
+            bag_of_words_affect=bag_of_words_affect,
+            knob=knob,
+            **kwargs
+        )
+
+    return interact_manual(
+        generate,
+        cond_text=widgets.Text(value='The book', description='Prompt'),
+        bag_of_words=widgets.Dropdown(
+            options=sorted(BAG_OF_WORDS_ARCHIVE_MAP), description='Topic'),
+        bag_of_words_affect=widgets.Dropdown(
+            options=list(AFFECT_CLASSES), description='Affect'),
+        knob=widgets.FloatSlider(
+            value=0.5, min=0, max=1, step=0.1, description='Knob'),
+    )
@@ -1,43 +1,184 @@
-from score_model import run_pplm_example
-from transformers.modeling_gpt2 import GPT2LMHeadModel
-from transformers import GPT2Tokenizer
-import torch
+"""Command line entry point for run_pplm_example.
+
+Every keyword of run_pplm_example is an option; --sweep runs one generation
+per job of a sweep spec (see sweep_queue.py for the format), with the
+command line options as defaults for every job. torch and transformers are
+only imported once generation starts, so --help and --check are instant.
+
+    python run.py --cond_text "The book" --bag_of_words legal \\
+        --bag_of_words_affect trust --knob 0.5
+    python run.py --sweep sweep.json --out results.jsonl
+"""
+import argparse
+import json
+import os
 import sys
 
+from lexicons import AFFECT_CLASSES, BAG_OF_WORDS_ARCHIVE_MAP
+
+
+def str2bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    value = str(value)
+    if value.lower() in ('1', 'true', 'yes', 'y'):
+        return True
+    if value.lower() in ('0', 'false', 'no', 'n'):
+        return False
+    raise argparse.ArgumentTypeError("expected a boolean, got {}".format(value))
+
+
+def label(value):
+    return int(value) if str(value).lstrip('-').isdigit() else value
+
+
+VERBOSITY = ['quiet', 'regular', 'verbose', 'very_verbose']
+
+# (name, type, help) for every keyword argument of run_pplm_example
+PARAMETERS = [
+    ('pretrained_model', str, "GPT-2 model name or path"),
+    ('weights_file', str, "exported weights to memory-map (shared_weights.py)"),
+    ('cond_text', str, "prefix texts to condition on"),
+    ('uncond', str2bool, "generate from the bos token only"),
+    ('num_samples', int, "number of perturbed samples"),
+    ('bag_of_words', str, "topic bags of words, ';' separated"),
+    ('bag_of_words_affect', str, "NRC lexicon affect classes, ';' separated"),
+    ('affect_weight', float, "weight of the affect loss"),
+    ('knob', float, "affect intensity, 0-1"),
+    ('discrim', str, "discriminator name"),
+    ('discrim_weights', str, "weights of a generic discriminator"),
+    ('discrim_meta', str, "meta json of a generic discriminator"),
+    ('class_label', label, "discriminator class name or id"),
+    ('length', int, "number of tokens to generate"),
+    ('stepsize', float, "initial perturbation step size"),
+    ('end_lr', float, "final step size of the polynomial decay"),
+    ('N', int, "decay steps of the polynomial decay"),
+    ('power', float, "power of the polynomial decay"),
+    ('beta1', float, "momentum of the perturbation update"),
+    ('temperature', float, "sampling temperature"),
+    ('top_k', int, "top-k filtering, 0 disables"),
+    ('sample', str2bool, "sample instead of greedy decoding"),
+    ('num_iterations', int, "perturbation iterations per token"),
+    ('grad_length', int, "stop perturbing after this many tokens"),
+    ('horizon_length', int, "tokens looked ahead by the discriminator"),
+    ('window_length', int, "perturbed past window, 0 for all"),
+    ('decay', str2bool, "decay the perturbation over the window"),
+    ('gamma', float, "gradient normalisation exponent"),
+    ('gm_scale', float, "weight of the perturbed distribution"),
+    ('score_scale', float, "weight of the similarity score loss"),
+    ('max_context', int, "sliding KV window for long-form, 0 for unbounded"),
+    ('sink_tokens', int, "attention sink positions kept in the window"),
+    ('refresh_tokens', int, "tokens between re-encodings of the window"),
+    ('max_sentences', int, "stop after this many sentences, 0 for no limit"),
+    ('stop_on_eos', str2bool, "stop on the end of text token"),
+    ('compile_step', str2bool, "compile the perturbation step (torch.compile)"),
+    ('compile_bucket', int, "past length bucket of the compiled step"),
+    ('gate_threshold', float, "skip/shorten perturbation once the unperturbed "
+                              "bag mass reaches this, 0 disables"),
+    ('gate_confidence', float, "skip/shorten perturbation when one token has "
+                               "this much probability, 0 disables"),
+    ('gate_iterations', int, "perturbation iterations on gated tokens"),
+    ('low_memory', str2bool, "final-layer hidden states only and activation "
+                             "checkpointing in the perturbed backward"),
+    ('seed', int, "random seed"),
+    ('no_cuda', str2bool, "run on the cpu"),
+    ('colorama', str2bool, "colour the output"),
+    ('verbosity', str, "one of " + ", ".join(VERBOSITY)),
+]
+PARAMETER_TYPES = {name: type_ for name, type_, _ in PARAMETERS}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Affect and topic controlled generation with GPT-2")
+    group = parser.add_argument_group("run_pplm_example parameters")
+    for name, type_, help_ in PARAMETERS:
+        group.add_argument("--" + name, type=type_, help=help_,
+                           default=argparse.SUPPRESS)
+    parser.add_argument("--sweep", help="JSON sweep spec to run job by job")
+    parser.add_argument("--out", help="append results as JSON lines here")
+    parser.add_argument("--check", action="store_true",
+                        help="validate the configuration and exit")
+    return parser
+
+
+def validate(params):
+    """Coerce sweep values to the option types and reject bad settings."""
+    checked = {}
+    for name, value in params.items():
+        if name not in PARAMETER_TYPES:
+            raise ValueError("unknown parameter {}".format(name))
+        if value is not None:
+            value = PARAMETER_TYPES[name](value)
+        checked[name] = value
+    if (checked.get('verbosity') or 'regular').lower() not in VERBOSITY:
+        raise ValueError("verbosity must be one of {}".format(VERBOSITY))
+    knob = checked.get('knob')
+    if knob is not None and not 0 <= knob <= 1:
+        raise ValueError("knob must be within 0-1, got {}".format(knob))
+    for name in ('length', 'num_samples', 'num_iterations'):
+        if checked.get(name) is not None and checked[name] < 0:
+            raise ValueError("{} must not be negative".format(name))
+    for topic in (checked.get('bag_of_words') or '').split(';'):
+        if topic and topic not in BAG_OF_WORDS_ARCHIVE_MAP \
+                and not os.path.isfile(topic):
+            raise ValueError("unknown bag of words {}, expected one of {} "
+                             "or a file".format(
+                                 topic, sorted(BAG_OF_WORDS_ARCHIVE_MAP)))
+    for affect in (checked.get('bag_of_words_affect') or '').split(';'):
+        if affect and affect not in AFFECT_CLASSES:
+            raise ValueError("unknown affect {}, expected one of {}".format(
+                affect, list(AFFECT_CLASSES)))
+    if checked.get('bag_of_words_affect') and knob is None:
+        raise ValueError("bag_of_words_affect needs a knob")
+    return checked
+
+
+def load_jobs(args):
+    base = {name: value for name, value in vars(args).items()
+            if name in PARAMETER_TYPES}
+    if args.sweep is None:
+        return [validate(base)]
+
+    from sweep_queue import expand_sweep
+    with open(args.sweep) as f:
+        spec = json.load(f)
+    jobs = []
+    for job in expand_sweep(spec):
+        params = dict(base)
+        params.update(job)
+        jobs.append(validate(params))
+    return jobs
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        jobs = load_jobs(args)
+    except (OSError, ValueError, TypeError,
+            argparse.ArgumentTypeError) as e:
+        print("error:", e, file=sys.stderr)
+        return 2
+    if args.check:
+        print("{} job(s) ok".format(len(jobs)))
+        return 0
+
+    from score_model import run_pplm_example
+    for params in jobs:
+        print(", ".join("{}: {}".format(key, params[key])
+                        for key in ('cond_text', 'bag_of_words',
+                                    'bag_of_words_affect', 'knob')
+                        if key in params))
+        output = run_pplm_example(return_metrics=True, **params)
+        for text in output["texts"]:
+            print(text)
+        if args.out:
+            with open(args.out, "a") as f:
+                f.write(json.dumps({"params": params, "result": output}) + "\n")
+    return 0
+
 
-topics = ["legal",'military','monsters', 'science','space','politics', 'religion','technology','positive_words']
-affects = ['anticipation', 'disgust', 'surprise', 'trust']#['joy', 'anger', 'sadness','fear']
-prompts = [ 'The book', 'The issue focused on', 'The robots', 'The relationship','The road']
-knob_vals = [0.1,0.5,1]
-outputs = []
-
-
-
-
-  for topic in topics:
-    for affect in affects:
-      for knob in knob_vals:
-        print("topic:", topic, ", affect:", affect, ", knob is:", knob)
-        
-        
-        output = run_pplm_example(
-            affect_weight=1,  
-            knob = knob, # 0-1,
-            cond_text=prompt,
-            num_samples=1,
-            bag_of_words=topic,
-            bag_of_words_affect=affect,
-            length=50,
-            stepsize=8e-4, 
-            sample=True,
-            num_iterations=40,
-            window_length=6,
-            gamma=1.5,
-            gm_scale=0.95,
-            score_scale=1,
-            verbosity='REGULAR',
-            end_lr = 1e-4,
-            N = 10,
-            power = 2
-        )
-        print(output)
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
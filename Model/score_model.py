@@ -1,24 +1,28 @@
 from __future__ import print_function
-import argparse
 import json
+import os
+import warnings
+from collections import deque
 from operator import add
 from typing import List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.autograd import Variable
-from tqdm import trange
-from transformers import GPT2Tokenizer
-from transformers.file_utils import cached_path
-from transformers.modeling_gpt2 import GPT2LMHeadModel
 
-from ipywidgets import interact, interactive, fixed, interact_manual
+from lexicons import BAG_OF_WORDS_ARCHIVE_MAP
+from shared_weights import load_shared_model
+
+# transformers and tqdm are imported where they are used so that importing
+# this module (and the command line's --help) stays cheap; notebook widgets
+# live in notebook.py
 # from flask_socketio import SocketIO, join_room, emit, send
-import ipywidgets as widgets
 
+# last characters emitted for a front-end to poll; bounded so that a long
+# running process does not keep every generated character alive
+RESULT_BUFFER_SIZE = 4096
 resultContainer = {
-    "text":[]
+    "text": deque(maxlen=RESULT_BUFFER_SIZE)
 }
 
 class ClassificationHead(torch.nn.Module):
@@ -56,18 +60,6 @@ VERBOSITY_LEVELS = {
     'very_verbose': VERY_VERBOSE,
 }
 
-BAG_OF_WORDS_ARCHIVE_MAP = {
-    'legal': "https://s3.amazonaws.com/models.huggingface.co/bert/pplm/bow/legal.txt",
-    'military': "https://s3.amazonaws.com/models.huggingface.co/bert/pplm/bow/military.txt",
-    'monsters': "https://s3.amazonaws.com/models.huggingface.co/bert/pplm/bow/monsters.txt",
-    'politics': "https://s3.amazonaws.com/models.huggingface.co/bert/pplm/bow/politics.txt",
-    'positive_words': "https://s3.amazonaws.com/models.huggingface.co/bert/pplm/bow/positive_words.txt",
-    'religion': "https://s3.amazonaws.com/models.huggingface.co/bert/pplm/bow/religion.txt",
-    'science': "https://s3.amazonaws.com/models.huggingface.co/bert/pplm/bow/science.txt",
-    'space': "https://s3.amazonaws.com/models.huggingface.co/bert/pplm/bow/space.txt",
-    'technology': "https://s3.amazonaws.com/models.huggingface.co/bert/pplm/bow/technology.txt",
-}
-
 DISCRIMINATOR_MODELS_PARAMS = {
     "clickbait": {
         "url": "https://s3.amazonaws.com/models.huggingface.co/bert/pplm/discriminators/clickbait_classifier_head.pt",
@@ -87,12 +79,24 @@ DISCRIMINATOR_MODELS_PARAMS = {
     },
 }
 
-def to_var(x, requires_grad=False, volatile=False, device='cuda'):
-    if torch.cuda.is_available() and device == 'cuda':
-        x = x.cuda()
-    elif device != 'cuda':
-        x = x.to(device)
-    return Variable(x, requires_grad=requires_grad, volatile=volatile)
+# Local directory checked for discriminator heads (by the basename of their
+# url) before falling back to the remote archive.
+DISCRIMINATOR_HEADS_DIR = os.environ.get("PPLM_DISCRIM_DIR", "discriminators")
+
+# Heads already loaded in this session, keyed by (name, url or path, device).
+CLASSIFIER_HEADS = {}
+
+# Perturbation step functions, keyed by whether they are compiled.
+PERTURBATION_STEPS = {}
+
+# (model, tokenizer) already loaded in this process, keyed by
+# (pretrained model, weights file, device, low memory), so a worker running
+# many jobs loads gpt2-medium once.
+LANGUAGE_MODELS = {}
+
+def cached_path(url):
+    from transformers.file_utils import cached_path as transformers_cached_path
+    return transformers_cached_path(url)
 
 
 def top_k_filter(logits, k, probs=False):
@@ -113,6 +117,140 @@ def top_k_filter(logits, k, probs=False):
                            torch.ones_like(logits) * -BIG_CONST,
                            logits)
 
+def window_tokens(tokens, max_length, sink_tokens=4):
+    """
+    The first sink_tokens (attention sinks) and the most recent tokens of
+    tokens, max_length in total. Re-encoding them gives the sliding window
+    fresh positions 0..max_length-1.
+    """
+    if tokens.shape[1] <= max_length:
+        return tokens
+    recent = max_length - sink_tokens
+    return torch.cat((tokens[:, :sink_tokens], tokens[:, -recent:]), dim=1)
+
+def model_forward(model, input_ids, past=None, low_memory=False, **kwargs):
+    """
+    Runs the LM and returns (logits, presents, hidden states). In low memory
+    mode the hidden states of the intermediate layers are never returned and
+    the tuple only holds the final one.
+    """
+    if not low_memory:
+        return model(input_ids, past_key_values=past, **kwargs)
+    outputs = model.transformer(input_ids, past_key_values=past,
+                                use_cache=True, output_hidden_states=False,
+                                **kwargs)
+    hidden = outputs[0]
+    return model.lm_head(hidden), outputs[1], (hidden,)
+
+def enable_activation_checkpointing(model):
+    """
+    Makes every transformer block recompute its activations during backward
+    instead of keeping them; blocks run as usual when no gradient is needed.
+    """
+    from torch.utils.checkpoint import checkpoint
+
+    for block in model.transformer.h:
+        if getattr(block, "checkpointed", False):
+            continue
+
+        def forward(hidden_states, layer_past=None, block_forward=block.forward,
+                    **kwargs):
+            needs_grad = torch.is_grad_enabled() and (
+                hidden_states.requires_grad
+                or (layer_past is not None and layer_past.requires_grad))
+            if not needs_grad:
+                return block_forward(hidden_states, layer_past=layer_past,
+                                     **kwargs)
+            return checkpoint(
+                lambda hidden, past: block_forward(hidden, layer_past=past,
+                                                   **kwargs),
+                hidden_states, layer_past, use_reentrant=False)
+
+        block.forward = forward
+        block.checkpointed = True
+    return model
+
+def pad_past(past, window_mask, length):
+    """
+    Zero-pads a past and its window mask to length positions.
+    """
+    pad = length - past[0].shape[-2]
+    past = tuple(F.pad(p_, (0, 0, 0, pad)) for p_ in past)
+    return past, F.pad(window_mask, (0, 0, 0, pad))
+
+def build_bag_index(bow_indices=None, bow_indices_affect=None,
+                    affect_int=None, knob=None, affect_weight=1.0,
+                    device='cuda'):
+    """
+    Concatenates every topic and affect bag into one segmented index: the
+    token id of each single-token word, the bag (segment) it belongs to and
+    its weight (1 for topic words, the knob's gaussian target for affect
+    words), plus per-bag loss weights. affect_int holds one list of
+    intensities per affect bag. Returns None without any bag.
+    """
+    token_ids, segments, token_weights = [], [], []
+    bag_weights, bag_scale, first_row = [], [], []
+
+    for single_bow in bow_indices or []:
+        words = [word[0] for word in single_bow if len(word) == 1]
+        segments.extend([len(bag_weights)] * len(words))
+        token_ids.extend(words)
+        token_weights.extend([1.0] * len(words))
+        bag_weights.append(1.0)
+        bag_scale.append(1.0)
+        first_row.append(False)
+
+    for single_bow, ints in zip(bow_indices_affect or [], affect_int or []):
+        pairs = [(word[0], intensity)
+                 for word, intensity in zip(single_bow, ints) if len(word) == 1]
+        segments.extend([len(bag_weights)] * len(pairs))
+        token_ids.extend(word for word, _ in pairs)
+        weights = gaussian([intensity for _, intensity in pairs], knob, .1)
+        token_weights.extend(weights)
+        bag_weights.append(affect_weight)
+        # largest weight of the bag, so gating compares masses on a 0-1 scale
+        bag_scale.append(max(weights, default=1.0))
+        # the affect loss only ever looked at the first batch row
+        first_row.append(True)
+
+    if not bag_weights:
+        return None
+    segments = torch.tensor(segments, dtype=torch.long, device=device)
+    token_weights = torch.tensor(token_weights, dtype=torch.float,
+                                 device=device)
+    first_row = torch.tensor(first_row, dtype=torch.bool, device=device)
+    return {
+        "token_ids": torch.tensor(token_ids, dtype=torch.long, device=device),
+        "segments": segments,
+        "token_weights": token_weights,
+        "token_first_row": first_row[segments],
+        "bag_weights": torch.tensor(bag_weights, dtype=torch.float,
+                                    device=device),
+        "bag_scale": torch.tensor(bag_scale, dtype=torch.float,
+                                  device=device),
+        "num_bags": len(bag_weights),
+    }
+
+def bag_probability_mass(probs, bag_index):
+    """
+    Weighted probability mass probs put on each bag of bag_index: one gather
+    over all bags' tokens and one segment sum.
+    """
+    gathered = probs[:, bag_index["token_ids"]]
+    mass = torch.where(bag_index["token_first_row"],
+                       gathered[0], torch.sum(gathered, dim=0))
+    mass = mass * bag_index["token_weights"]
+    return torch.zeros(bag_index["num_bags"], dtype=mass.dtype,
+                       device=mass.device).index_add(
+        0, bag_index["segments"], mass)
+
+def bag_loss(probs, bag_index):
+    """
+    Sum of the weighted -log masses of all topic and affect bags.
+    """
+    return torch.sum(bag_index["bag_weights"]
+                     * -torch.log(bag_probability_mass(probs, bag_index)))
+
 def gaussian(x, mu, sig):
   x = np.array(x)
   return list(np.exp(-0.5*((x-mu)/sig)**2)/(sig*(2*np.pi)**0.5))
@@ -127,10 +265,7 @@ def perturb_past(
         accumulated_hidden=None,
         grad_norms=None,
         stepsize=0.01,
-        one_hot_bows_vectors=None,
-        one_hot_bows_affect=None,
-        affect_int = None,
-        knob = None,
+        bag_index=None,
         classifier=None,
         class_label=None,
         loss_type=0,
@@ -145,7 +280,11 @@ def perturb_past(
         beta1=0.6,
         end_lr = 0.5,
         N = 15,
-        power = 2
+        power = 2,
+        compile_step=False,
+        compile_bucket=32,
+        stop_after=None,
+        low_memory=False
 ):
     # Generate inital perturbed past
 #     unpart = past + tuple()
@@ -191,124 +330,211 @@ def perturb_past(
     else:
         window_mask = torch.ones_like(past[0]).to(device)
 
-    # accumulate perturbations for num_iterations
-    loss_per_iter = []
-    new_accumulated_hidden = None
-    for i in range(1,num_iterations+1):
-        if verbosity_level >= VERBOSE:
-            print("Iteration ", i + 1)
-#         unpart = past + tuple()
-        past = tuple([
-            to_var(p_, requires_grad=True, device=device)
-            for p_ in past
-        ])
-        # Compute hidden using perturbed past 
-        perturbed_past = past
-        _, _, _, curr_length, _ = perturbed_past[0].shape
-        all_logits, _, all_hidden = model(last, past_key_values=perturbed_past)
+    # shape bucketing: the compiled step sees the past padded to a multiple
+    # of compile_bucket positions, so it is recompiled once per bucket
+    # rather than once per token
+    past = tuple(p_.detach() for p_ in past)
+    step_inputs = {}
+    # the per-loss prints need eager tensors, and activation checkpointing
+    # does not compose with the functional transform
+    compile_step = (compile_step and verbosity_level < VERY_VERBOSE
+                    and not low_memory)
+    if compile_step:
+        # a slice of the output buffer and a sampled token differ in strides,
+        # which would make the compiled step guard and recompile on them
+        last = last.clone(memory_format=torch.contiguous_format)
+    if compile_step and compile_bucket > 0:
+        padded_length = -(-curr_length // compile_bucket) * compile_bucket
+        # the padded past plus the new tokens must fit GPT-2's causal mask
+        max_positions = getattr(model.config, "n_ctx",
+                                getattr(model.config, "n_positions", None))
+        if max_positions:
+            padded_length = max(curr_length, min(
+                padded_length, max_positions - last.shape[1]))
+        if padded_length > curr_length:
+            past, window_mask = pad_past(past, window_mask, padded_length)
+        attention_mask = torch.zeros(
+            (last.shape[0], padded_length + last.shape[1]), device=device)
+        attention_mask[:, :curr_length] = 1
+        attention_mask[:, padded_length:] = 1
+        step_inputs["attention_mask"] = attention_mask
+        step_inputs["position_ids"] = torch.arange(
+            curr_length, curr_length + last.shape[1],
+            device=device).unsqueeze(0).expand_as(last)
+
+    unpert_probs = None
+    if score_scale > 0.0:
+        unpert_probs = F.softmax(unpert_logits[:, -1, :], dim=-1)
+
+    def loss_fn(all_logits, all_hidden):
         hidden = all_hidden[-1]
         new_accumulated_hidden = accumulated_hidden + torch.sum(
             hidden,
             dim=1
-        ).detach()
-        
+        )
+
         logits = all_logits[:, -1, :]
         probs = F.softmax(logits, dim=-1)
 
         loss = 0.0
-        loss_list = []
-        if loss_type == PPLM_BOW or loss_type == BOW_AFFECT:
-            for one_hot_bow in one_hot_bows_vectors:
-                bow_logits = torch.mm(probs, torch.t(one_hot_bow))
-                #print(type(bow_logits))
-                bow_loss = -torch.log(torch.sum(bow_logits))
-                #print(bow_loss)
-                loss +=  bow_loss
-                loss_list.append(bow_loss)
-            if loss_type == BOW_AFFECT:
-              for one_hot_bow in one_hot_bows_affect:
-                  bow_logits = torch.mm(probs, torch.t(one_hot_bow))
-                 # print(bow_logits.size(), torch.FloatTensor(affect_int).size())
-                  bow_loss = -torch.log(torch.matmul(bow_logits, torch.t(torch.FloatTensor(gaussian(affect_int, knob, .1)).to(device))))#-torch.log(torch.sum(bow_logits))#
-                  # print(bow_loss)
-
-                  loss += affect_weight * bow_loss[0]
-                  loss_list.append(bow_loss)
+        if (loss_type in (PPLM_BOW, PPLM_BOW_DISCRIM, BOW_AFFECT)
+                and bag_index is not None):
+            # topic and affect bags together: one gather, one segment sum
+            loss += bag_loss(probs, bag_index)
             if verbosity_level >= VERY_VERBOSE:
                 print(" pplm_bow_loss:", loss.data.cpu().numpy())
 
-        score_loss = 0.0
+        if classifier is not None and loss_type != PPLM_BOW:
+            # one matmul over every row of the batch
+            prediction = classifier(new_accumulated_hidden / (curr_length + 1))
+            label = torch.full((prediction.shape[0],), class_label,
+                               device=device, dtype=torch.long)
+            discrim_loss = F.cross_entropy(prediction, label)
+            if verbosity_level >= VERY_VERBOSE:
+                print(" pplm_discrim_loss:", discrim_loss.data.cpu().numpy())
+            loss += discrim_loss
+
         # To Calculate the KL Loss every iteration we need the unpert prob every iteration but it is no calculated
-        
-        if score_scale > 0.0 :
-            unpert_probs = F.softmax(unpert_logits[:, -1, :], dim=-1)
+        if unpert_probs is not None:
             score = torch.sum(torch.mul(unpert_probs,probs)/(torch.norm(probs)*torch.norm(unpert_probs)))
             score_loss = -score_scale *  score
             loss += score_loss
             if verbosity_level >= VERY_VERBOSE:
                 print(' Score_loss', score_loss.data.cpu().numpy())
-        
-        
-        loss_per_iter.append(loss.data.cpu().numpy())
+        return loss, new_accumulated_hidden
+
+    step = get_perturbation_step(compile_step)
+    keep_max_norms = grad_norms is not None and loss_type == PPLM_BOW
+    m_t = tuple(torch.zeros_like(p_) for p_ in past)
+
+    # accumulate perturbations for num_iterations
+    loss_per_iter = []
+    new_accumulated_hidden = None
+    perturbed_past = past
+    for i in range(1,num_iterations+1):
+        # a shortened run keeps the full schedule's first iterations
+        if stop_after is not None and i > stop_after:
+            break
         if verbosity_level >= VERBOSE:
-            print(' Total_loss', (loss).data.cpu().numpy())
-        
-        # compute gradients
-        loss.backward()
-#         print(past[0].grad),curr_perturbation[0].grad)
-
-#         # calculate gradient norms
-        if grad_norms is not None and loss_type == PPLM_BOW:
-            grad_norms = [
-                torch.max(grad_norms[index], torch.norm(p_.grad * window_mask))
-                for index, p_ in enumerate(perturbed_past)
-            ]
-        else:
-            grad_norms = [
-                (torch.norm(p_.grad * window_mask) + SMALL_CONST)
-                for index, p_ in enumerate(perturbed_past)
-            ]
-
-        # Initialise m_0
-        m_0 = tuple([ torch.tensor(np.zeros(p.shape).astype("float32")) for p in perturbed_past ])
-        grad = tuple([
-            (p_.grad * window_mask/ grad_norms[index] ** gamma ).data.cpu().numpy()
-            for index, p_ in enumerate(perturbed_past)
-        ])
-#         print(perturbed_past)
+            print("Iteration ", i + 1)
         # beta1 = 0.6
-#         beta2 = 0.99
-#         print(len(m_0))
         # end_lr = 0.5
         # N = 15
-        # alpha= end_lr
         initial_lr = stepsize - end_lr
         lr = initial_lr * ((num_iterations - i)/(num_iterations - N)) ** power # Polynomial Decay
         # lr = stepsize * (alpha**np.floor(i/N)) # Exponential Decay
         r_t = beta1/(1 - (beta1)**i)
         r_t_1 = (1 - beta1)/(1 - (beta1)**i)
-        if i ==1:
-            m_t = [(r_t*momentum) + (r_t_1*grad[index]) for index , momentum in enumerate(m_0)] 
-        else:
-            m_t = [(r_t*momentum) + (r_t_1*grad[index]) for index , momentum in enumerate(m_t)]
-        
-#         print(grad[0][0][0].shape)
-        # perturbing the past
-        past = [torch.tensor(perturbed_past[index].detach() - lr * m_t[index].to(device)) for index , p_ in enumerate(perturbed_past)]
-#         print(perturbed_past[0],grad[0],type(grad[0]),type(perturbed_past[0]))
-
-        # reset gradients, just to make sure
-        for p_ in perturbed_past:
-            p_.grad.data.zero_()
-        
-        
-        
-        
-
-    pert_past = perturbed_past
+
+        # scalars go in as tensors so a compiled step is not specialised
+        # on every iteration's values
+        perturbed_past = past
+        past, m_t, grad_norms, loss, new_accumulated_hidden = step(
+            past, model, last, loss_fn, window_mask, m_t,
+            grad_norms if keep_max_norms else None,
+            torch.tensor(lr, device=device),
+            torch.tensor(r_t, device=device),
+            torch.tensor(r_t_1, device=device),
+            gamma,
+            step_inputs,
+            low_memory
+        )
+        keep_max_norms = loss_type == PPLM_BOW
+        loss_per_iter.append(loss)
+        if verbosity_level >= VERBOSE:
+            print(' Total_loss', loss.cpu().numpy())
+
+    # the past used in the last iteration is the one handed back
+    pert_past = tuple(p_[..., :curr_length, :] for p_ in perturbed_past)
+    # kept a tuple: the compiled step would recompile for a list
+    loss_per_iter = [loss.cpu().numpy() for loss in loss_per_iter]
     return pert_past, new_accumulated_hidden, grad_norms, loss_per_iter
 
 
+def perturbation_step(
+        past,
+        model,
+        last,
+        loss_fn,
+        window_mask,
+        m_t,
+        grad_norms,
+        lr,
+        r_t,
+        r_t_1,
+        gamma,
+        step_inputs,
+        low_memory=False,
+        functional=False
+):
+    """
+    One perturbation iteration: perturbed forward, loss, gradient
+    normalisation and momentum update of the past.
+    """
+    def forward(past):
+        all_logits, _, all_hidden = model_forward(model, last, past,
+                                                  low_memory, **step_inputs)
+        return loss_fn(all_logits, all_hidden)
+
+    if functional:
+        # traceable as one graph by torch.compile, unlike autograd.grad
+        grads, (loss, new_accumulated_hidden) = torch.func.grad_and_value(
+            forward, has_aux=True)(past)
+    else:
+        past = tuple(p_.detach().requires_grad_(True) for p_ in past)
+        loss, new_accumulated_hidden = forward(past)
+        grads = torch.autograd.grad(loss, past)
+
+    if grad_norms is not None:
+        grad_norms = tuple(
+            torch.max(norm, torch.norm(grad * window_mask))
+            for norm, grad in zip(grad_norms, grads)
+        )
+    else:
+        grad_norms = tuple(
+            torch.norm(grad * window_mask) + SMALL_CONST for grad in grads
+        )
+    m_t = tuple(
+        r_t * momentum + r_t_1 * (grad * window_mask / norm ** gamma)
+        for momentum, grad, norm in zip(m_t, grads, grad_norms)
+    )
+    # perturbing the past
+    past = tuple(p_.detach() - lr * momentum for p_, momentum in zip(past, m_t))
+    return (past, m_t, grad_norms, loss.detach(),
+            new_accumulated_hidden.detach())
+
+
+def _functional_perturbation_step(*args):
+    return perturbation_step(*args, functional=True)
+
+
+def get_perturbation_step(compile_step=False):
+    """
+    Returns perturbation_step, compiled with torch.compile when asked for and
+    available; a compiled step that fails falls back to eager mode.
+    """
+    if (not compile_step or not hasattr(torch, "compile")
+            or not hasattr(torch, "func")):
+        return perturbation_step
+    if True not in PERTURBATION_STEPS:
+        # one graph per past length bucket, window and batch shape
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, 64)
+        compiled = torch.compile(_functional_perturbation_step)
+
+        def step(*args):
+            try:
+                return compiled(*args)
+            except Exception as e:
+                warnings.warn("compiled perturbation step failed, "
+                              "falling back to eager: {}".format(e))
+                PERTURBATION_STEPS[True] = perturbation_step
+                return perturbation_step(*args)
+
+        PERTURBATION_STEPS[True] = step
+    return PERTURBATION_STEPS[True]
+
+
 def get_classifier(
         name: Optional[str],
         class_label: Union[str, int],
@@ -319,20 +545,34 @@ def get_classifier(
         return None, None
 
     params = DISCRIMINATOR_MODELS_PARAMS[name]
-    classifier = ClassificationHead(
-        class_size=params['class_size'],
-        embed_size=params['embed_size']
-    ).to(device)
-    if "url" in params:
-        resolved_archive_file = cached_path(params["url"])
-    elif "path" in params:
-        resolved_archive_file = params["path"]
-    else:
+    if "path" not in params and "url" not in params:
         raise ValueError("Either url or path have to be specified "
                          "in the discriminator model parameters")
-    classifier.load_state_dict(
-        torch.load(resolved_archive_file, map_location=device))
-    classifier.eval()
+
+    # looked up before any file is resolved: cached_path makes a remote etag
+    # request even when the head is already in its cache
+    key = (name, params.get("path") or params["url"], str(device))
+    classifier = CLASSIFIER_HEADS.get(key)
+    if classifier is None:
+        if "path" in params:
+            resolved_archive_file = params["path"]
+        else:
+            local_file = os.path.join(DISCRIMINATOR_HEADS_DIR,
+                                      os.path.basename(params["url"]))
+            if os.path.isfile(local_file):
+                resolved_archive_file = local_file
+            else:
+                resolved_archive_file = cached_path(params["url"])
+        classifier = ClassificationHead(
+            class_size=params['class_size'],
+            embed_size=params['embed_size']
+        ).to(device)
+        classifier.load_state_dict(
+            torch.load(resolved_archive_file, map_location=device))
+        classifier.eval()
+        for param in classifier.parameters():
+            param.requires_grad = False
+        CLASSIFIER_HEADS[key] = classifier
 
     if isinstance(class_label, str):
         if class_label in params["class_vocab"]:
@@ -385,45 +625,6 @@ def get_affect_words_and_int (affect_class):
   words = [w.split("\t") for w in words]
   return [w[0] for w in words if w[1] == affect_class], [float(w[-1]) for w in words if w[1] == affect_class]
 
-def build_bows_one_hot_vectors(bow_indices, tokenizer, device='cuda'):
-    if bow_indices is None:
-        return None
-
-    one_hot_bows_vectors = []
-    for single_bow in bow_indices:
-        single_bow = list(filter(lambda x: len(x) <= 1, single_bow))
-
-        single_bow = torch.tensor(single_bow).to(device)
-        num_words = single_bow.shape[0]
-        # print(num_words)
-        one_hot_bow = torch.zeros(num_words, tokenizer.vocab_size).to(device)
-        one_hot_bow.scatter_(1, single_bow, 1)
-        one_hot_bows_vectors.append(one_hot_bow)
-    return one_hot_bows_vectors
-
-def build_bows_one_hot_vectors_aff(bow_indices,affect_int, tokenizer, device='cuda'):
-    if bow_indices is None or affect_int is None:
-        return None, None
-
-    one_hot_bows_vectors = []
-    # print(np.array(bow_indices).shape)
-    for single_bow in bow_indices:
-        zipped = [[single_bow[i], affect_int[i]] for i in range(len(single_bow))]
-        single_bow_int = list(filter(lambda x: len(x[0]) <= 1, zipped))
-        single_bow = [single_bow_int[i][0] for i in range(len(single_bow_int)) ]
-        affect_ints = [single_bow_int[i][1] for i in range(len(single_bow_int)) ]
-        # print(single_bow, affect_ints)
-        # print(len(single_bow), len(affect_ints))
-        single_bow = torch.tensor(single_bow).to(device)
-        num_words = single_bow.shape[0]
-        # print(num_words)
-        one_hot_bow = torch.zeros(num_words, tokenizer.vocab_size).to(device)
-        one_hot_bow.scatter_(1, single_bow, 1)
-        one_hot_bows_vectors.append(one_hot_bow)
-    return one_hot_bows_vectors, affect_ints
-
-
-
 def full_text_generation(
         model,
         tokenizer,
@@ -454,6 +655,17 @@ def full_text_generation(
         end_lr = 0.5,
         N = 15,
         power = 2,
+        max_context=0,
+        sink_tokens=4,
+        refresh_tokens=32,
+        max_sentences=2,
+        stop_on_eos=False,
+        compile_step=False,
+        compile_bucket=32,
+        gate_threshold=0.0,
+        gate_confidence=0.0,
+        gate_iterations=0,
+        low_memory=False,
         **kwargs
 ):
     classifier, class_id = get_classifier(discrim, class_label, device)
@@ -461,16 +673,22 @@ def full_text_generation(
     # print("affect is: ", bag_of_words_affect)
     bow_indices = []
     bow_indices_affect = []
+    affect_int = None
     if bag_of_words:
       bow_indices = get_bag_of_words_indices(bag_of_words.split(";"), tokenizer)
     if bag_of_words_affect: 
-      affect_words, affect_int = get_affect_words_and_int(bag_of_words_affect)
-      bow_indices_affect.append([tokenizer.encode(word.strip(),add_prefix_space=True, add_special_tokens=False)for word in affect_words])
+      affect_int = []
+      for affect in bag_of_words_affect.split(";"):
+        affect_words, affect_ints = get_affect_words_and_int(affect)
+        bow_indices_affect.append([tokenizer.encode(word.strip(),add_prefix_space=True, add_special_tokens=False)for word in affect_words])
+        affect_int.append(affect_ints)
     loss_type = PPLM_BOW
     if bag_of_words_affect:
       loss_type = BOW_AFFECT
+    elif classifier is not None:
+      loss_type = PPLM_BOW_DISCRIM if bag_of_words else PPLM_DISCRIM
 
-    unpert_gen_tok_text, _, _ = generate_text_pplm(
+    unpert_gen_tok_text, _, _, _, _ = generate_text_pplm(
         model=model,
         tokenizer=tokenizer,
         context=context,
@@ -478,18 +696,24 @@ def full_text_generation(
         length=length,
         sample=sample,
         perturb=False,
-        verbosity_level=verbosity_level
+        verbosity_level=verbosity_level,
+        low_memory=low_memory,
+        max_context=max_context,
+        sink_tokens=sink_tokens,
+            refresh_tokens=refresh_tokens,
+        max_sentences=max_sentences,
+        stop_on_eos=stop_on_eos
     )
 
-    if device == 'cuda':
-        torch.cuda.empty_cache()
-
     pert_gen_tok_texts = []
     discrim_losses = []
     losses_in_time = []
+    int_scores = []
+    gate_logs = []
     print("After Perturbation")
     for i in range(num_samples):
-        pert_gen_tok_text, discrim_loss, loss_in_time = generate_text_pplm(
+        (pert_gen_tok_text, discrim_loss, loss_in_time, int_score,
+         gate_log) = generate_text_pplm(
             model=model,
             tokenizer=tokenizer,
             affect_weight=affect_weight,
@@ -520,17 +744,28 @@ def full_text_generation(
             beta1=beta1,
             end_lr = end_lr,
             N = N,
-            power = power
+            power = power,
+            max_context=max_context,
+            sink_tokens=sink_tokens,
+            refresh_tokens=refresh_tokens,
+            max_sentences=max_sentences,
+            stop_on_eos=stop_on_eos,
+            compile_step=compile_step,
+            compile_bucket=compile_bucket,
+            gate_threshold=gate_threshold,
+            gate_confidence=gate_confidence,
+            gate_iterations=gate_iterations,
+            low_memory=low_memory
         )
         pert_gen_tok_texts.append(pert_gen_tok_text)
         if classifier is not None:
             discrim_losses.append(discrim_loss.data.cpu().numpy())
         losses_in_time.append(loss_in_time)
+        int_scores.append(int_score)
+        gate_logs.append(gate_log)
 
-    if device == 'cuda':
-        torch.cuda.empty_cache()
-
-    return unpert_gen_tok_text, pert_gen_tok_texts, discrim_losses, losses_in_time
+    return (unpert_gen_tok_text, pert_gen_tok_texts, discrim_losses,
+            losses_in_time, int_scores, gate_logs)
 
 
 def get_affect_words_and_int1 (affect_class):
@@ -541,6 +776,37 @@ def get_affect_words_and_int1 (affect_class):
   words = [w.split("\t") for w in words]
   return [w[0] for w in words if w[-1] == affect_class], [float(w[1]) for w in words if w[-1] == affect_class]
 
+def get_language_model(pretrained_model="gpt2-medium", weights_file=None,
+                       device="cuda", low_memory=False):
+    key = (pretrained_model, weights_file, str(device), low_memory)
+    if key in LANGUAGE_MODELS:
+        return LANGUAGE_MODELS[key]
+
+    from transformers import GPT2Tokenizer
+    from transformers.modeling_gpt2 import GPT2LMHeadModel
+
+    # load pretrained model, memory-mapped from an exported file if given
+    if weights_file is not None:
+        model = load_shared_model(weights_file, output_hidden_states=True)
+    else:
+        model = GPT2LMHeadModel.from_pretrained(
+            pretrained_model,
+            output_hidden_states=True
+        )
+    model.to(device)
+    model.eval()
+
+    # load tokenizer
+    tokenizer = GPT2Tokenizer.from_pretrained(pretrained_model)
+
+    # Freeze GPT-2 weights
+    for param in model.parameters():
+        param.requires_grad = False
+    if low_memory:
+        enable_activation_checkpointing(model)
+    LANGUAGE_MODELS[key] = (model, tokenizer)
+    return model, tokenizer
+
 def run_pplm_example(
         pretrained_model="gpt2-medium",
         cond_text="",
@@ -574,7 +840,20 @@ def run_pplm_example(
         beta1=0.6,
         end_lr = 0.5,
         N = 15,
-        power = 2
+        power = 2,
+        weights_file=None,
+        max_context=0,
+        sink_tokens=4,
+        refresh_tokens=32,
+        max_sentences=2,
+        stop_on_eos=False,
+        compile_step=False,
+        compile_bucket=32,
+        gate_threshold=0.0,
+        gate_confidence=0.0,
+        gate_iterations=0,
+        low_memory=False,
+        return_metrics=False
         ):
     # set Random seed
     torch.manual_seed(seed)
@@ -600,20 +879,14 @@ def run_pplm_example(
                 print("discrim = {}, pretrained_model set "
                 "to discriminator's = {}".format(discrim, pretrained_model))
 
-    # load pretrained model
-    model = GPT2LMHeadModel.from_pretrained(
-        pretrained_model,
-        output_hidden_states=True
-    )
-    model.to(device)
-    model.eval()
-
-    # load tokenizer
-    tokenizer = GPT2Tokenizer.from_pretrained(pretrained_model)
-
-    # Freeze GPT-2 weights
-    for param in model.parameters():
-        param.requires_grad = False
+    model, tokenizer = get_language_model(pretrained_model, weights_file,
+                                          device, low_memory)
+    # the peak is measured against what is allocated once the weights are
+    # loaded, so it is the generation's own (activation and cache) memory
+    base_memory = 0
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
 
     # figure out conditioning text
     if uncond:
@@ -628,8 +901,10 @@ def run_pplm_example(
     # generate unperturbed and perturbed texts
 
     # full_text_generation returns:
-    # unpert_gen_tok_text, pert_gen_tok_texts, discrim_losses, losses_in_time
-    unpert_gen_tok_text, pert_gen_tok_texts, _, _ = full_text_generation(
+    # unpert_gen_tok_text, pert_gen_tok_texts, discrim_losses, losses_in_time,
+    # int_scores, gate_logs
+    (unpert_gen_tok_text, pert_gen_tok_texts, discrim_losses, losses_in_time,
+     int_scores, gate_logs) = full_text_generation(
         model=model,
         tokenizer=tokenizer,
         affect_weight=affect_weight,
@@ -658,8 +933,29 @@ def run_pplm_example(
         beta1=beta1,
         end_lr = end_lr,
         N = N,
-        power = power
+        power = power,
+        max_context=max_context,
+        sink_tokens=sink_tokens,
+            refresh_tokens=refresh_tokens,
+        max_sentences=max_sentences,
+        stop_on_eos=stop_on_eos,
+        compile_step=compile_step,
+        compile_bucket=compile_bucket,
+        gate_threshold=gate_threshold,
+        gate_confidence=gate_confidence,
+        gate_iterations=gate_iterations,
+        low_memory=low_memory
     )
+    peak_memory = None
+    if device == 'cuda':
+        batch_rows = (len(tokenized_cond_text)
+                      if tokenized_cond_text
+                      and isinstance(tokenized_cond_text[0], list) else 1)
+        peak_memory = ((torch.cuda.max_memory_allocated() - base_memory)
+                       / batch_rows)
+        if verbosity_level >= REGULAR:
+            print("peak memory per batch row above the weights: "
+                  "{:.1f} MiB".format(peak_memory / 2 ** 20))
 
     # untokenize unperturbed text
     unpert_gen_text = tokenizer.decode(unpert_gen_tok_text.tolist()[0])
@@ -671,12 +967,14 @@ def run_pplm_example(
     print()
 
     generated_texts = []
+    pert_gen_texts = []
 
     # iterate through the perturbed texts
     for i, pert_gen_tok_text in enumerate(pert_gen_tok_texts):
         try:
             # untokenize unperturbed text
             pert_gen_text = tokenizer.decode(pert_gen_tok_text.tolist()[0])
+            pert_gen_texts.append(pert_gen_text)
             # print("= Perturbed generated text {} =".format(i + 1))
             # print(pert_gen_text)
             # print()
@@ -688,6 +986,24 @@ def run_pplm_example(
             (tokenized_cond_text, pert_gen_tok_text, unpert_gen_tok_text)
         )
 
+    if return_metrics:
+        # plain python values so results can go straight into json
+        return {
+            # one text per sample, in the order of int_scores etc.
+            "texts": pert_gen_texts,
+            "unpert_text": unpert_gen_text,
+            "int_scores": [float(score) for score in int_scores],
+            "discrim_losses": [float(loss) for loss in discrim_losses],
+            "losses_in_time": [
+                [[float(loss) for loss in iteration_losses]
+                 for iteration_losses in loss_in_time]
+                for loss_in_time in losses_in_time
+            ],
+            # perturbation iterations run for each token
+            "gate_iterations": gate_logs,
+            # bytes per batch row above the loaded weights, cuda only
+            "peak_memory": peak_memory,
+        }
     return pert_gen_text
 
 def generate_text_pplm(
@@ -722,33 +1038,87 @@ def generate_text_pplm(
         beta1=0.6,
         end_lr = 0.5,
         N = 15,
-        power = 2
+        power = 2,
+        max_context=0,
+        sink_tokens=4,
+        refresh_tokens=32,
+        max_sentences=2,
+        stop_on_eos=False,
+        compile_step=False,
+        compile_bucket=32,
+        gate_threshold=0.0,
+        gate_confidence=0.0,
+        gate_iterations=0,
+        low_memory=False
 ):
+    # max_context > 0 is the long-form mode: the unperturbed pass is run
+    # incrementally and both caches are capped to a sliding window. GPT-2
+    # takes positions from the cache length, so rather than evicting single
+    # positions the window is re-encoded from the tokens with positions
+    # 0..max_context-refresh_tokens-1 and then grows for refresh_tokens
+    # tokens. The perturbed cache is rebuilt unperturbed at every re-encode.
+    long_form = max_context > 0
+    window_length_tokens = max_context - refresh_tokens
+    if long_form and (context is None or refresh_tokens < 1
+                      or window_length_tokens <= sink_tokens + 1):
+        raise ValueError("long-form generation needs a context, "
+                         "refresh_tokens >= 1 and "
+                         "max_context - refresh_tokens > sink_tokens + 1")
+
+    # tokens are written into a preallocated buffer instead of re-cat'ing
     output_so_far = None
+    context_length = 0
+    context_t = None
     if context:
         context_t = torch.tensor(context, device=device, dtype=torch.long)
         while len(context_t.shape) < 2:
             context_t = context_t.unsqueeze(0)
-        output_so_far = context_t
-
-    # collect one hot vectors for bags of words
-    one_hot_bows_vectors = build_bows_one_hot_vectors(bow_indices, tokenizer, device)
-    affect_int_orig = affect_int
-    one_hot_bows_affect, affect_int = build_bows_one_hot_vectors_aff(bow_indices_affect, affect_int, tokenizer, device)
-#    print(torch.FloatTensor(one_hot_bows_affect).size())
+        context_length = context_t.shape[1]
+    output_buffer = torch.empty(
+        (1 if context_t is None else context_t.shape[0],
+         context_length + length),
+        device=device, dtype=torch.long)
+    if context_t is not None:
+        output_buffer[:, :context_length] = context_t
+        output_so_far = output_buffer[:, :context_length]
+    position = context_length
+
+    # collect all bags of words into one segmented index; a flat affect_int
+    # is the intensities of a single affect bag
+    if affect_int and not isinstance(affect_int[0], (list, tuple)):
+        affect_int = [affect_int]
+    bag_index = build_bag_index(
+        bow_indices,
+        bow_indices_affect if loss_type == BOW_AFFECT else None,
+        affect_int, knob, affect_weight, device)
+    # gating: tokens whose unperturbed distribution already puts
+    # gate_threshold mass on every bag, or gate_confidence on a single token,
+    # get gate_iterations perturbation iterations (0 skips them)
+    gate = perturb and num_iterations > 0 and (
+        gate_threshold > 0 or gate_confidence > 0)
+    gate_log = []
     grad_norms = None
     last = None
+    unpert_past = None
+    unpert_hidden_sum = None
+    unpert_seen = 0
     unpert_discrim_loss = 0
     loss_in_time = []
+    affect_lookup = {}
+    for single_bow, ints in zip(bow_indices_affect or [], affect_int or []):
+        for word, intensity in zip(single_bow, ints):
+            if len(word) == 1:
+                affect_lookup.setdefault(word[0], intensity)
 
     if verbosity_level >= VERBOSE:
+        from tqdm import trange
         range_func = trange(length, ascii=True)
     else:
         range_func = range(length)
     count = 0
     int_score = 0
     for i in range_func:
-        if count == 2:
+        if max_sentences and count == max_sentences:
           break
         # Get past/probs for current output, except for last word
         # Note that GPT takes 2 inputs: past + current_token
@@ -756,11 +1126,37 @@ def generate_text_pplm(
         # run model forward to obtain unperturbed
         if past is None and output_so_far is not None:
             last = output_so_far[:, -1:]
-            if output_so_far.shape[1] > 1:
-                _, past, _ = model(output_so_far[:, :-1])
-
-        unpert_logits, unpert_past, unpert_all_hidden = model(output_so_far)
+            # long-form builds it from the window below
+            if output_so_far.shape[1] > 1 and not long_form:
+                _, past, _ = model_forward(model, output_so_far[:, :-1],
+                                           low_memory=low_memory)
+
+        if not long_form:
+            unpert_logits, unpert_past, unpert_all_hidden = model_forward(
+                model, output_so_far, low_memory=low_memory)
+        elif unpert_past is None or unpert_past[0].shape[-2] >= max_context:
+            unpert_logits, unpert_past, unpert_all_hidden = model_forward(
+                model,
+                window_tokens(output_so_far, window_length_tokens, sink_tokens),
+                low_memory=low_memory)
+            # the window without its last token is the unperturbed past
+            past = (tuple(p_[..., :-1, :] for p_ in unpert_past)
+                    if unpert_past[0].shape[-2] > 1 else None)
+        else:
+            unpert_logits, unpert_past, unpert_all_hidden = model_forward(
+                model, last, unpert_past, low_memory=low_memory)
         unpert_last_hidden = unpert_all_hidden[-1]
+        if long_form:
+            # the evicted positions have no hidden state any more, so keep
+            # a running sum over the whole history
+            if unpert_hidden_sum is None:
+                unpert_hidden_sum = torch.sum(
+                    unpert_last_hidden[:, :-1, :], dim=1)
+                unpert_seen = unpert_last_hidden.shape[1] - 1
+            history_mean = unpert_hidden_sum / max(unpert_seen, 1)
+            unpert_hidden_sum = (unpert_hidden_sum
+                                 + unpert_last_hidden[:, -1, :])
+            unpert_seen += 1
 
         # check if we are abowe grad max length
         if i >= grad_length:
@@ -773,10 +1169,38 @@ def generate_text_pplm(
             pert_past = past
 
         else:
-            accumulated_hidden = unpert_last_hidden[:, :-1, :]
-            accumulated_hidden = torch.sum(accumulated_hidden, dim=1)
-
-            if past is not None:
+            if long_form:
+                # the history mean rescaled to the window that perturb_past
+                # averages over
+                accumulated_hidden = history_mean * (
+                    past[0].shape[-2] if past is not None else 0)
+            else:
+                accumulated_hidden = unpert_last_hidden[:, :-1, :]
+                accumulated_hidden = torch.sum(accumulated_hidden, dim=1)
+
+            # nothing to perturb for the first token without a context
+            iterations = num_iterations if past is not None else 0
+            if gate and past is not None:
+                gate_probs = F.softmax(unpert_logits[:, -1, :], dim=-1)
+                mass = None
+                if bag_index is not None:
+                    mass = torch.min(
+                        bag_probability_mass(gate_probs, bag_index)
+                        / bag_index["bag_scale"]).item()
+                if ((gate_threshold > 0 and mass is not None
+                     and mass >= gate_threshold)
+                        or (gate_confidence > 0
+                            and torch.max(gate_probs).item() >= gate_confidence)):
+                    iterations = min(gate_iterations, num_iterations)
+                if verbosity_level >= VERBOSE:
+                    print("gate: bow mass", mass, "iterations", iterations)
+            gate_log.append(iterations)
+
+            if iterations == 0:
+                pert_past = past
+                # keeps loss_in_time aligned with gate_log and the tokens
+                loss_in_time.append([])
+            else:
                 pert_past, _, grad_norms, loss_this_iter = perturb_past(
                     past,
                     model,
@@ -787,10 +1211,7 @@ def generate_text_pplm(
                     accumulated_hidden=accumulated_hidden,
                     grad_norms=grad_norms,
                     stepsize=current_stepsize,
-                    one_hot_bows_vectors=one_hot_bows_vectors,
-                    one_hot_bows_affect=one_hot_bows_affect,
-                    affect_int = affect_int,
-                    knob = knob,
+                    bag_index=bag_index,
                     classifier=classifier,
                     class_label=class_label,
                     loss_type=loss_type,
@@ -805,21 +1226,28 @@ def generate_text_pplm(
                     beta1=beta1,
                     end_lr = end_lr,
                     N = N,
-                    power = power
+                    power = power,
+                    compile_step=compile_step,
+                    compile_bucket=compile_bucket,
+                    stop_after=iterations,
+                    low_memory=low_memory
                 )
                 loss_in_time.append(loss_this_iter)
-            else:
-                pert_past = past
 
-        pert_logits, past, pert_all_hidden = model(last, past=pert_past)
+        pert_logits, past, pert_all_hidden = model_forward(
+            model, last, pert_past, low_memory=low_memory)
         pert_logits = pert_logits[:, -1, :] / temperature  # + SMALL_CONST
         pert_probs = F.softmax(pert_logits, dim=-1)
 
         if classifier is not None:
             ce_loss = torch.nn.CrossEntropyLoss()
-            prediction = classifier(torch.mean(unpert_last_hidden, dim=1))
-            label = torch.tensor([class_label], device=device,
-                                 dtype=torch.long)
+            if long_form:
+                # the whole history, not just the newly fed token
+                prediction = classifier(unpert_hidden_sum / unpert_seen)
+            else:
+                prediction = classifier(torch.mean(unpert_last_hidden, dim=1))
+            label = torch.full((prediction.shape[0],), class_label,
+                               device=device, dtype=torch.long)
             unpert_discrim_loss = ce_loss(prediction, label)
             if verbosity_level >= VERBOSE:
                 print(
@@ -856,27 +1284,35 @@ def generate_text_pplm(
             _, last = torch.topk(pert_probs, k=1, dim=-1)
 
         # update context/output_so_far appending the new token
-        output_so_far = (
-            last if output_so_far is None
-            else torch.cat((output_so_far, last), dim=1)
-        )
-
-        resultContainer["text"].append(tokenizer.decode(output_so_far.tolist()[0])[-1])
+        output_buffer[:, position] = last[:, 0]
+        position += 1
+        output_so_far = output_buffer[:, :position]
+
+        # only the new token is decoded, never the whole output
+        last_token = last[0, 0].item()
+        last_text = tokenizer.decode([last_token])
+        if last_text:
+            resultContainer["text"].append(last_text[-1])
         # toemit = tokenizer.decode(output_so_far.tolist()[0])
         # toemit = toemit.split("<|endoftext|>")[1]
         # if perturb:
             # emit('word', {"value": toemit}, broadcast=True)
         if verbosity_level >= REGULAR:
-            print(tokenizer.decode(output_so_far.tolist()[0]))
-        if(tokenizer.decode(output_so_far.tolist()[0])[-1] == '.' ):
+            if long_form:
+                print(last_text, end="", flush=True)
+            else:
+                print(tokenizer.decode(output_so_far.tolist()[0]))
+        if last_text.endswith('.'):
           count = count+1
-        if bow_indices_affect is not None and [output_so_far.tolist()[0][-1]] in bow_indices_affect[0]:
-          int_word = affect_int_orig[bow_indices_affect[0].index([output_so_far.tolist()[0][-1]])]
-          print(tokenizer.decode(output_so_far.tolist()[0][-1]), int_word)
+        if last_token in affect_lookup:
+          int_word = affect_lookup[last_token]
+          print(last_text, int_word)
           int_score = int_score + int_word
+        if stop_on_eos and last_token == tokenizer.eos_token_id:
+          break
     print("int_score: ", int_score)
     # print("int.. " , output_so_far.tolist()[0][-1])
-    return output_so_far, unpert_discrim_loss, loss_in_time
+    return output_so_far, unpert_discrim_loss, loss_in_time, int_score, gate_log
 
 
 
@@ -0,0 +1,134 @@
+"""Zero-copy GPT-2 weights shared between generation workers on one host.
+
+`export_weights` writes a model's state dict once as a flat file: an 8 byte
+header length, a JSON header (model config, tensor names, dtypes, shapes and
+offsets) and the raw tensor bytes. `load_shared_model` memory-maps that file
+copy-on-write, so every worker reads the same page-cache pages instead of
+holding its own copy of gpt2-medium. Put the file under /dev/shm to keep it in
+shared memory, or load it once in a parent and fork the workers afterwards.
+
+    python shared_weights.py /dev/shm/gpt2-medium.pplm --pretrained_model gpt2-medium
+"""
+import argparse
+import json
+import struct
+
+import numpy as np
+import torch
+
+ALIGNMENT = 64
+TIED_WEIGHTS = {"lm_head.weight": "transformer.wte.weight"}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def export_weights(model, path):
+    state_dict = model.state_dict()
+    tensors = {}
+    tied = {}
+    offset = 0
+    for name, tensor in state_dict.items():
+        if name in TIED_WEIGHTS and TIED_WEIGHTS[name] in state_dict:
+            tied[name] = TIED_WEIGHTS[name]
+            continue
+        array = tensor.detach().cpu().contiguous().numpy()
+        offset = _align(offset)
+        tensors[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset += array.nbytes
+
+    header = json.dumps({
+        "config": model.config.to_dict(),
+        "tensors": tensors,
+        "tied": tied,
+    }).encode("utf-8")
+    data_start = _align(8 + len(header))
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, meta in tensors.items():
+            f.seek(data_start + meta["offset"])
+            f.write(state_dict[name].detach().cpu().contiguous().numpy().tobytes())
+    return path
+
+
+def load_weights(path):
+    """Map every tensor of an exported file without copying it."""
+    with open(path, "rb") as f:
+        header_len, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = _align(8 + header_len)
+
+    # mode 'c' is copy-on-write: pages stay shared unless a worker writes
+    buffer = np.memmap(path, dtype=np.uint8, mode="c")
+    weights = {}
+    for name, meta in header["tensors"].items():
+        dtype = np.dtype(meta["dtype"])
+        count = int(np.prod(meta["shape"], dtype=np.int64))
+        start = data_start + meta["offset"]
+        array = buffer[start:start + count * dtype.itemsize].view(dtype)
+        weights[name] = torch.from_numpy(array.reshape(meta["shape"]))
+    for alias, name in header["tied"].items():
+        weights[alias] = weights[name]
+    return header["config"], weights
+
+
+def _empty_model(model_class, config):
+    # Skip allocating and initialising random weights that are about to be
+    # replaced; torch < 2.0 has no meta device context and pays that cost.
+    try:
+        with torch.device("meta"):
+            return model_class(config)
+    except (AttributeError, TypeError):
+        return model_class(config)
+
+
+def load_shared_model(path, output_hidden_states=True):
+    from transformers import GPT2Config
+    from transformers.modeling_gpt2 import GPT2LMHeadModel
+
+    config_dict, weights = load_weights(path)
+    config = GPT2Config.from_dict(config_dict)
+    config.output_hidden_states = output_hidden_states
+    model = _empty_model(GPT2LMHeadModel, config)
+
+    missing = set(model.state_dict().keys()) - set(weights.keys())
+    if missing:
+        raise ValueError("{} does not contain weights for {}".format(
+            path, sorted(missing)))
+
+    for name, tensor in weights.items():
+        module_name, _, leaf = name.rpartition(".")
+        module = model
+        for attr in filter(None, module_name.split(".")):
+            module = getattr(module, attr)
+        if leaf in module._parameters:
+            module._parameters[leaf] = torch.nn.Parameter(
+                tensor, requires_grad=False)
+        else:
+            module._buffers[leaf] = tensor
+    model.tie_weights()
+    for name, buffer in model.named_buffers():
+        if buffer.device.type == "meta":
+            raise ValueError("buffer {} was not restored from {}".format(
+                name, path))
+    model.eval()
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export pretrained GPT-2 weights for shared loading")
+    parser.add_argument("path")
+    parser.add_argument("--pretrained_model", default="gpt2-medium")
+    args = parser.parse_args()
+
+    from transformers.modeling_gpt2 import GPT2LMHeadModel
+    export_weights(GPT2LMHeadModel.from_pretrained(args.pretrained_model),
+                   args.path)
@@ -0,0 +1,301 @@
+"""Memory-leak and throughput soak run of generate_text_pplm.
+
+Runs thousands of perturbed generations in one process against a tiny,
+randomly initialised GPT-2 (no download) and a byte-level tokenizer. Every
+window of generations it samples the resident set size, the number of live
+tensors and tokens/s. The run fails (exit status 1) when
+
+* RSS or the live tensor count keeps growing after the warm-up windows,
+* throughput drops more than --max_slowdown below the stored baseline,
+* RSS ends more than --max_rss_increase above the stored baseline.
+
+Baselines are kept per run configuration (device, length, iterations,
+max_context, low_memory) in soak_baseline.json next to this file. A
+configuration without one fails; --update_baseline records the run as the
+baseline, after the leak checks pass, and skips the baseline comparison.
+Throughput depends on the machine: the committed numbers are a reference
+from a single cpu, and a CI runner should record and commit its own.
+
+    python soak.py --generations 2000 --window 100
+    python soak.py --low_memory --max_context 64 --update_baseline
+"""
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from score_model import BOW_AFFECT, QUIET, generate_text_pplm, resultContainer
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "soak_baseline.json")
+VOCAB_SIZE = 257  # 256 bytes + end of text
+EOS_TOKEN_ID = 256
+
+
+class ByteTokenizer(object):
+    """Byte-level stand-in for GPT2Tokenizer, enough for generate_text_pplm."""
+
+    eos_token_id = EOS_TOKEN_ID
+
+    def encode(self, text):
+        return list(text.encode("latin-1", "replace"))
+
+    def decode(self, token_ids):
+        return bytes(token for token in token_ids
+                     if token < EOS_TOKEN_ID).decode("latin-1")
+
+
+def build_tiny_model(n_embd=64, n_layer=2, n_head=2, n_positions=1024,
+                     low_memory=False, seed=0):
+    from transformers import GPT2Config
+    from transformers.modeling_gpt2 import GPT2LMHeadModel
+
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=VOCAB_SIZE, n_positions=n_positions,
+                        n_ctx=n_positions, n_embd=n_embd, n_layer=n_layer,
+                        n_head=n_head, bos_token_id=EOS_TOKEN_ID,
+                        eos_token_id=EOS_TOKEN_ID,
+                        output_hidden_states=not low_memory)
+    model = GPT2LMHeadModel(config)
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad = False
+    return model
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        # peak rather than current RSS; kilobytes on linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+def live_tensors():
+    gc.collect()
+    count = 0
+    with warnings.catch_warnings():
+        # isinstance checks trip deprecation warnings of lazy torch attributes
+        warnings.simplefilter("ignore")
+        for obj in gc.get_objects():
+            try:
+                if torch.is_tensor(obj):
+                    count += 1
+            except ReferenceError:
+                pass
+    return count
+
+
+def synthetic_bags(rng, bags=2, words=40):
+    """Random single-token topic and affect bags over the byte vocabulary."""
+    def bag():
+        return [[int(token)] for token in
+                rng.choice(EOS_TOKEN_ID, words, replace=False)]
+    bow_indices = [bag() for _ in range(bags)]
+    bow_indices_affect = [bag()]
+    affect_int = [[float(value) for value in rng.uniform(0, 1, words)]]
+    return bow_indices, bow_indices_affect, affect_int
+
+
+def growth(samples, key, per=1000):
+    """Least-squares growth of samples[key] per `per` generations."""
+    if len(samples) < 2:
+        return 0.0
+    x = np.array([sample["generations"] for sample in samples], dtype=float)
+    y = np.array([sample[key] for sample in samples], dtype=float)
+    return float(np.polyfit(x, y, 1)[0] * per)
+
+
+def run_soak(generations=2000, window=100, warmup=2, length=20,
+             num_iterations=3, max_context=0, low_memory=False, seed=0,
+             device="cpu", verbosity_level=1):
+    """Returns the per-window samples of a soak run."""
+    model = build_tiny_model(low_memory=low_memory, seed=seed).to(device)
+    if low_memory:
+        from score_model import enable_activation_checkpointing
+        enable_activation_checkpointing(model)
+    tokenizer = ByteTokenizer()
+    rng = np.random.RandomState(seed)
+    bow_indices, bow_indices_affect, affect_int = synthetic_bags(rng)
+    context = tokenizer.encode("The soak test of the affect model")
+
+    samples = []
+    tokens = 0
+    start = time.time()
+    with open(os.devnull, "w") as devnull:
+        for index in range(1, generations + 1):
+            torch.manual_seed(seed + index)
+            # generate_text_pplm prints its int_score regardless of verbosity
+            with contextlib.redirect_stdout(devnull):
+                output = generate_text_pplm(
+                    model=model,
+                    tokenizer=tokenizer,
+                    context=context,
+                    device=device,
+                    perturb=True,
+                    bow_indices=bow_indices,
+                    bow_indices_affect=bow_indices_affect,
+                    affect_int=affect_int,
+                    knob=rng.uniform(0, 1),
+                    loss_type=BOW_AFFECT,
+                    length=length,
+                    num_iterations=num_iterations,
+                    max_context=max_context,
+                    max_sentences=0,
+                    verbosity_level=QUIET,
+                    low_memory=low_memory
+                )[0]
+            tokens += output.shape[1] - len(context)
+            del output
+
+            if index % window == 0:
+                elapsed = time.time() - start
+                sample = {
+                    "generations": index,
+                    "tokens_per_second": tokens / elapsed,
+                    "rss_mb": rss_mb(),
+                    "tensors": live_tensors(),
+                    "result_buffer": len(resultContainer["text"]),
+                }
+                if device == "cuda":
+                    sample["cuda_mb"] = torch.cuda.memory_allocated() / 2 ** 20
+                samples.append(sample)
+                if verbosity_level >= 1:
+                    print(json.dumps(sample))
+                # sampling (gc walk) is not counted against throughput
+                tokens = 0
+                start = time.time()
+    return samples[warmup:] if len(samples) > warmup + 1 else samples
+
+
+def summarize(samples):
+    summary = {
+        "tokens_per_second": float(np.median(
+            [sample["tokens_per_second"] for sample in samples])),
+        "rss_mb": samples[-1]["rss_mb"],
+        "rss_growth_mb": growth(samples, "rss_mb"),
+        "tensor_growth": growth(samples, "tensors"),
+    }
+    if "cuda_mb" in samples[-1]:
+        summary["cuda_growth_mb"] = growth(samples, "cuda_mb")
+    return summary
+
+
+def check(summary, baseline=None, max_rss_growth=5.0, max_tensor_growth=1.0,
+          max_slowdown=0.2, max_rss_increase=0.25):
+    """Returns the list of failed checks, empty when the run passes."""
+    failures = []
+    for key, limit in (("rss_growth_mb", max_rss_growth),
+                       ("cuda_growth_mb", max_rss_growth),
+                       ("tensor_growth", max_tensor_growth)):
+        if summary.get(key, 0.0) > limit:
+            failures.append("{} {:.2f} per 1000 generations exceeds {}".format(
+                key, summary[key], limit))
+    if baseline:
+        floor = baseline["tokens_per_second"] * (1 - max_slowdown)
+        if summary["tokens_per_second"] < floor:
+            failures.append(
+                "tokens/s {:.1f} below {:.1f} (baseline {:.1f} - {:.0%})".format(
+                    summary["tokens_per_second"], floor,
+                    baseline["tokens_per_second"], max_slowdown))
+        ceiling = baseline["rss_mb"] * (1 + max_rss_increase)
+        if summary["rss_mb"] > ceiling:
+            failures.append(
+                "rss {:.1f} MiB above {:.1f} (baseline {:.1f} + {:.0%})".format(
+                    summary["rss_mb"], ceiling, baseline["rss_mb"],
+                    max_rss_increase))
+    return failures
+
+
+def baseline_key(config):
+    """Baselines are keyed by the run configuration only, not the host."""
+    return ",".join("{}={}".format(key, config[key]) for key in sorted(config))
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(path, baselines):
+    with open(path, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--generations", type=int, default=2000)
+    parser.add_argument("--window", type=int, default=100,
+                        help="generations between samples")
+    parser.add_argument("--warmup", type=int, default=2,
+                        help="leading windows left out of the checks")
+    parser.add_argument("--length", type=int, default=20)
+    parser.add_argument("--num_iterations", type=int, default=3)
+    parser.add_argument("--max_context", type=int, default=0)
+    parser.add_argument("--low_memory", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no_cuda", action="store_true")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update_baseline", action="store_true",
+                        help="record this run as the configuration's "
+                             "baseline if it passes the leak checks")
+    parser.add_argument("--max_rss_growth", type=float, default=5.0,
+                        help="MiB of RSS growth per 1000 generations")
+    parser.add_argument("--max_tensor_growth", type=float, default=1.0,
+                        help="live tensors gained per 1000 generations")
+    parser.add_argument("--max_slowdown", type=float, default=0.2,
+                        help="allowed tokens/s drop below the baseline")
+    parser.add_argument("--max_rss_increase", type=float, default=0.25,
+                        help="allowed final RSS above the baseline")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() and not args.no_cuda \
+        else "cpu"
+    config = {"length": args.length, "num_iterations": args.num_iterations,
+              "max_context": args.max_context, "low_memory": args.low_memory,
+              "device": device}
+    samples = run_soak(args.generations, args.window, args.warmup,
+                       args.length, args.num_iterations, args.max_context,
+                       args.low_memory, args.seed, device)
+    summary = summarize(samples)
+
+    baselines = load_baselines(args.baseline)
+    key = baseline_key(config)
+    baseline = None if args.update_baseline else baselines.get(key)
+    failures = check(summary, baseline, args.max_rss_growth,
+                     args.max_tensor_growth, args.max_slowdown,
+                     args.max_rss_increase)
+    if key not in baselines and not args.update_baseline:
+        failures.append("no baseline for {} in {}; record one with "
+                        "--update_baseline".format(key, args.baseline))
+    print(json.dumps({"summary": summary, "baseline": baselines.get(key)},
+                     indent=2, sort_keys=True))
+    for failure in failures:
+        print("FAIL:", failure)
+    if failures:
+        sys.exit(1)
+    if args.update_baseline:
+        baselines[key] = dict(summary, recorded_with={
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "generations": args.generations,
+        })
+        save_baselines(args.baseline, baselines)
+        print("baseline for {} recorded in {}".format(key, args.baseline))
+    print("ok")
@@ -0,0 +1,283 @@
+"""Persistent work queue for large run_pplm_example sweeps.
+
+A sweep spec is a JSON file with the keyword arguments shared by every job
+and a grid of values to sweep over, e.g.
+
+    {
+        "fixed": {"length": 50, "num_iterations": 40, "verbosity": "quiet"},
+        "grid": {
+            "cond_text": ["The book", "The road"],
+            "bag_of_words": ["legal", "military"],
+            "bag_of_words_affect": ["trust", "disgust"],
+            "knob": [0.1, 0.5, 1],
+            "stepsize": [8e-4],
+            "gm_scale": [0.95]
+        }
+    }
+
+`init` expands the grid into one row per job in an SQLite file. Workers on
+any host that can open the file (a local disk or a shared filesystem with
+working POSIX locks) lease one job at a time and keep the lease alive with a
+heartbeat. A lease that is not renewed expires and the job goes back to the
+queue; results are only accepted from the current lease holder, so a job that
+was requeued is never counted twice.
+
+    python sweep_queue.py init sweep.json queue.db
+    python sweep_queue.py worker queue.db --workers 4
+    python sweep_queue.py status queue.db
+    python sweep_queue.py results queue.db results.jsonl
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+LEASE_SECONDS = 120
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    params TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL DEFAULT 'pending',
+    lease_token TEXT,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires);
+"""
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def expand_sweep(spec):
+    fixed = spec.get("fixed", {})
+    grid = spec.get("grid", {})
+    keys = sorted(grid)
+    for values in itertools.product(*(grid[key] for key in keys)):
+        params = dict(fixed)
+        params.update(zip(keys, values))
+        yield params
+
+
+def init_queue(db_path, spec):
+    """Add every job of a sweep spec; jobs already in the queue are kept."""
+    conn = connect(db_path)
+    rows = [(json.dumps(params, sort_keys=True),)
+            for params in expand_sweep(spec)]
+    conn.execute("BEGIN IMMEDIATE")
+    conn.executemany("INSERT OR IGNORE INTO jobs (params) VALUES (?)", rows)
+    conn.execute("COMMIT")
+    conn.close()
+    return len(rows)
+
+
+def _requeue_expired(conn, now):
+    conn.execute(
+        "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+        "lease_token = NULL, error = 'lease expired' "
+        "WHERE status = ? AND lease_expires < ?",
+        (MAX_ATTEMPTS, FAILED, PENDING, LEASED, now))
+
+
+def lease_job(conn, worker, lease_seconds=LEASE_SECONDS):
+    """Return (job_id, lease_token, params) or None when nothing is pending."""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _requeue_expired(conn, now)
+        row = conn.execute(
+            "SELECT id, params FROM jobs WHERE status = ? ORDER BY id LIMIT 1",
+            (PENDING,)).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        token = uuid.uuid4().hex
+        conn.execute(
+            "UPDATE jobs SET status = ?, lease_token = ?, worker = ?, "
+            "lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+            (LEASED, token, worker, now + lease_seconds, row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row[0], token, json.loads(row[1])
+
+
+def heartbeat(conn, job_id, token, lease_seconds=LEASE_SECONDS):
+    """Extend a lease; False means it expired and may be handed out again."""
+    now = time.time()
+    cur = conn.execute(
+        "UPDATE jobs SET lease_expires = ? "
+        "WHERE id = ? AND lease_token = ? AND status = ? AND lease_expires >= ?",
+        (now + lease_seconds, job_id, token, LEASED, now))
+    return cur.rowcount == 1
+
+
+def complete_job(conn, job_id, token, result):
+    """Store a result; an expired lease is rejected even if not yet requeued."""
+    cur = conn.execute(
+        "UPDATE jobs SET status = ?, result = ?, lease_token = NULL "
+        "WHERE id = ? AND lease_token = ? AND status = ? AND lease_expires >= ?",
+        (DONE, json.dumps(result), job_id, token, LEASED, time.time()))
+    return cur.rowcount == 1
+
+
+def fail_job(conn, job_id, token, error):
+    cur = conn.execute(
+        "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+        "error = ?, lease_token = NULL "
+        "WHERE id = ? AND lease_token = ? AND status = ?",
+        (MAX_ATTEMPTS, FAILED, PENDING, error, job_id, token, LEASED))
+    return cur.rowcount == 1
+
+
+def queue_status(db_path):
+    conn = connect(db_path)
+    counts = dict(conn.execute(
+        "SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    conn.close()
+    return counts
+
+
+def export_results(db_path, out_path):
+    conn = connect(db_path)
+    rows = conn.execute(
+        "SELECT id, params, result FROM jobs WHERE status = ? ORDER BY id",
+        (DONE,)).fetchall()
+    conn.close()
+    with open(out_path, "w") as f:
+        for job_id, params, result in rows:
+            f.write(json.dumps({"id": job_id,
+                                "params": json.loads(params),
+                                "result": json.loads(result)}) + "\n")
+    return len(rows)
+
+
+def run_job(params):
+    from score_model import run_pplm_example
+    return run_pplm_example(return_metrics=True, **params)
+
+
+def _active_leases(conn):
+    return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?",
+                        (LEASED,)).fetchone()[0]
+
+
+def run_worker(db_path, worker=None, job_fn=None,
+               lease_seconds=LEASE_SECONDS, max_jobs=None,
+               poll_seconds=POLL_SECONDS):
+    """
+    Lease and run jobs until none are pending or leased; returns jobs
+    completed. While other workers hold leases it keeps polling, so the job
+    of a worker that died is picked up once its lease expires.
+    """
+    worker = worker or "{}:{}".format(socket.gethostname(), os.getpid())
+    job_fn = job_fn or run_job
+    conn = connect(db_path)
+    completed = 0
+    while max_jobs is None or completed < max_jobs:
+        leased = lease_job(conn, worker, lease_seconds)
+        if leased is None:
+            if not _active_leases(conn):
+                break
+            time.sleep(poll_seconds)
+            continue
+        job_id, token, params = leased
+
+        stop = threading.Event()
+
+        def beat():
+            beat_conn = connect(db_path)
+            while not stop.wait(lease_seconds / 3.0):
+                if not heartbeat(beat_conn, job_id, token, lease_seconds):
+                    break
+            beat_conn.close()
+
+        beater = threading.Thread(target=beat, daemon=True)
+        beater.start()
+        try:
+            result = job_fn(params)
+        except Exception as e:
+            stop.set()
+            beater.join()
+            fail_job(conn, job_id, token, repr(e))
+            continue
+        stop.set()
+        beater.join()
+        if complete_job(conn, job_id, token, result):
+            completed += 1
+    conn.close()
+    return completed
+
+
+def run_local_workers(db_path, workers, lease_seconds=LEASE_SECONDS,
+                      job_fn=None, poll_seconds=POLL_SECONDS):
+    """Start several worker processes on this host and wait for them."""
+    procs = [multiprocessing.Process(
+                target=run_worker,
+                args=(db_path,),
+                kwargs={"lease_seconds": lease_seconds, "job_fn": job_fn,
+                        "poll_seconds": poll_seconds})
+             for _ in range(workers)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    sub = parser.add_subparsers(dest="command")
+
+    init_parser = sub.add_parser("init", help="queue every job of a sweep spec")
+    init_parser.add_argument("spec")
+    init_parser.add_argument("db")
+
+    worker_parser = sub.add_parser("worker", help="run jobs from the queue")
+    worker_parser.add_argument("db")
+    worker_parser.add_argument("--workers", type=int, default=1)
+    worker_parser.add_argument("--lease_seconds", type=float,
+                               default=LEASE_SECONDS)
+
+    status_parser = sub.add_parser("status", help="count jobs by status")
+    status_parser.add_argument("db")
+
+    results_parser = sub.add_parser("results", help="export finished jobs")
+    results_parser.add_argument("db")
+    results_parser.add_argument("out")
+
+    args = parser.parse_args()
+    if args.command == "init":
+        with open(args.spec) as f:
+            print("queued", init_queue(args.db, json.load(f)), "jobs")
+    elif args.command == "worker":
+        if args.workers > 1:
+            run_local_workers(args.db, args.workers, args.lease_seconds)
+        else:
+            run_worker(args.db, lease_seconds=args.lease_seconds)
+    elif args.command == "status":
+        print(json.dumps(queue_status(args.db), sort_keys=True))
+    elif args.command == "results":
+        print("exported", export_results(args.db, args.out), "results")
+    else:
+        parser.print_help()
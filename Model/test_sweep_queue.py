@@ -0,0 +1,67 @@
+"""Lease protocol of sweep_queue, run on one box with stub jobs."""
+import json
+import time
+
+from sweep_queue import (DONE, LEASED, PENDING, complete_job, connect,
+                         export_results, heartbeat, init_queue, lease_job,
+                         queue_status, run_local_workers, run_worker)
+
+SPEC = {"fixed": {"length": 5}, "grid": {"knob": [0.1, 0.5, 0.9]}}
+
+
+def echo_job(params):
+    return {"text": "knob {}".format(params["knob"])}
+
+
+def make_queue(tmp_path, spec=SPEC):
+    db_path = str(tmp_path / "queue.db")
+    init_queue(db_path, spec)
+    return db_path
+
+
+def test_expired_lease_is_requeued_and_stale_token_rejected(tmp_path):
+    db_path = make_queue(tmp_path)
+    conn = connect(db_path)
+    job_id, stale_token, _ = lease_job(conn, "dead", lease_seconds=0.05)
+    time.sleep(0.1)
+
+    # expired but not yet requeued: neither renewed nor accepted
+    assert not heartbeat(conn, job_id, stale_token)
+    assert not complete_job(conn, job_id, stale_token, {"text": "late"})
+
+    # the next lease requeues it and hands it out under a new token
+    leased = [lease_job(conn, "live") for _ in range(3)]
+    assert job_id in [job[0] for job in leased]
+    token = dict((job[0], job[1]) for job in leased)[job_id]
+    assert token != stale_token
+    assert not complete_job(conn, job_id, stale_token, {"text": "late"})
+    assert complete_job(conn, job_id, token, {"text": "ok"})
+    attempts = conn.execute("SELECT attempts FROM jobs WHERE id = ?",
+                            (job_id,)).fetchone()[0]
+    assert attempts == 2
+
+
+def test_worker_waits_for_the_lease_of_a_dead_worker(tmp_path):
+    db_path = make_queue(tmp_path)
+    conn = connect(db_path)
+    lease_job(conn, "dead", lease_seconds=0.3)
+
+    completed = run_worker(db_path, job_fn=echo_job, poll_seconds=0.05)
+    assert completed == 3
+    assert queue_status(db_path) == {DONE: 3}
+
+
+def test_local_workers_run_every_job_once(tmp_path):
+    spec = {"grid": {"knob": [i / 10.0 for i in range(12)]}}
+    db_path = make_queue(tmp_path, spec)
+    run_local_workers(db_path, 3, job_fn=echo_job, poll_seconds=0.05)
+
+    status = queue_status(db_path)
+    assert status.get(DONE) == 12
+    assert PENDING not in status and LEASED not in status
+    out = str(tmp_path / "results.jsonl")
+    assert export_results(db_path, out) == 12
+    with open(out) as f:
+        rows = [json.loads(line) for line in f]
+    assert sorted(row["result"]["text"] for row in rows) == sorted(
+        "knob {}".format(row["params"]["knob"]) for row in rows)